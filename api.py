@@ -3,17 +3,76 @@ import vk_auth
 import sys
 import urllib
 import json
+import multiprocessing
+import threading
 import time
+from http_pool import http_pool
+from metrics import metrics
+from retry import *
 
 
-API_RETRY_COUNT = 15
+API_RETRY_COUNT = 10
+API_BASE_URL = "https://api.vk.com/method/"
+API_REQUESTS_PER_SECOND = 3  # VK allows 3 requests per second for a user token
+
+
+# 1 - unknown error, 6 - too many requests per second, 9 - flood control, 10 - internal server error.
+# Other errors (access denied, deleted user, invalid parameters and so on) are not going to go away on retry
+TRANSIENT_API_ERROR_CODES = (1, 6, 9, 10)
+
+
+class VkApiError(RuntimeError):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def is_transient_api_error(error):
+    if isinstance(error, VkApiError):
+        return error.code in TRANSIENT_API_ERROR_CODES
+    return is_transient_error(error)
+
+
+api_retry_policy = RetryPolicy(API_RETRY_COUNT, 1, 30, is_transient_api_error)
 
 
 config = configparser.ConfigParser()
 config.read('config.ini')
 
 
+# token bucket holding a single token, so requests are evenly spaced just under the rate limit
+class RateLimiter:
+    def __init__(self, rate, capacity=1, lock=None, state=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.lock = lock if lock is not None else threading.Lock()
+        # [tokens, updated_at], kept in shared memory when the limiter is shared between processes
+        self.state = state if state is not None else [capacity, time.monotonic()]
+
+    def share(self):
+        # all processes using the returned limiter draw tokens from the same bucket
+        return RateLimiter(self.rate, self.capacity, multiprocessing.Lock(),
+                           multiprocessing.RawArray('d', [self.capacity, time.monotonic()]))
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                tokens = min(self.capacity, self.state[0] + (now - self.state[1]) * self.rate)
+                self.state[1] = now
+                if tokens >= 1:
+                    self.state[0] = tokens - 1
+                    return
+                self.state[0] = tokens
+                wait = (1 - tokens) / self.rate
+            time.sleep(wait)
+
+
 class VkApi:
+    # shared by all instances, so every API call goes through the same limit
+    rate_limiter = RateLimiter(API_REQUESTS_PER_SECOND)
+    base_url = API_BASE_URL
+
     token = config.get('auth', 'token', fallback=None)
     user_id = config.get('auth', 'user_id', fallback=None)
     login = config.get('auth', 'login', fallback=None)
@@ -51,20 +110,35 @@ class VkApi:
     def call(self, method, params):
         params.append(("access_token", self.token))
         params.append(("v", "5.74"))
-        url = "https://api.vk.com/method/%s?%s" % (method, urllib.parse.urlencode(params))
+        url = self.base_url + method
+        # parameters are sent in request body, so long lists of ids or execute code do not hit url length limits
+        data = urllib.parse.urlencode(params).encode('utf-8')
 
-        for j in range(API_RETRY_COUNT):
-            try:
-                reply = json.loads(urllib.request.urlopen(url, timeout=20).read().decode("utf-8"))
-                if 'error' in reply:
-                    error_msg = reply['error']['error_msg']
-                    if error_msg.endswith('.'):
-                        error_msg = error_msg[:-1]
-                    raise RuntimeError(error_msg)
-                else:
-                    return reply['response']
-            except Exception as error:
-                sys.stdout.write('Got error while requesting api method %s (%s), trying to resume in 5 sec...\n' % (method, str(error)))
-                time.sleep(5)
-
-        raise RuntimeError('Failed to call the API\n')
+        def request():
+            with metrics.timer('api.rate_limit_wait'):
+                self.rate_limiter.acquire()
+            metrics.count('api.requests')
+            with http_pool.urlopen(url, timeout=20, data=data) as response:
+                reply = json.loads(response.read().decode("utf-8"))
+            if 'error' in reply:
+                error_msg = reply['error']['error_msg']
+                if error_msg.endswith('.'):
+                    error_msg = error_msg[:-1]
+                raise VkApiError(reply['error'].get('error_code', 0), error_msg)
+            return reply['response']
+
+        def report_retry(error, delay):
+            metrics.count('api.retries')
+            sys.stdout.write('Got error while requesting api method %s (%s), trying to resume in %.1f sec...\n'
+                             % (method, str(error), delay))
+
+        metrics.count('api.calls')
+        try:
+            with metrics.timer('api.' + method):
+                return api_retry_policy.run(request, report_retry)
+        except VkApiError:
+            metrics.count('api.errors')
+            raise
+        except Exception as error:
+            metrics.count('api.errors')
+            raise RuntimeError('Failed to call the API (%s)' % str(error))
@@ -0,0 +1,93 @@
+"""
+Checks that memoized fmt_timestamp gives the same result as formatting every timestamp with strftime. Every second
+around each change of the local time zone offset between 1970 and 2038 is checked, plus random timestamps.
+
+    python bench/check_timestamps.py [--zones America/St_Johns,Europe/Moscow] [--all-zones] [--samples 100000]
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import utils
+
+
+DEFAULT_ZONES = ['UTC', 'Europe/Moscow', 'Europe/London', 'America/New_York', 'America/St_Johns',
+                 'America/Goose_Bay', 'Asia/Kolkata', 'Asia/Kathmandu', 'Australia/Lord_Howe', 'Pacific/Chatham']
+FIRST_TIMESTAMP = 0
+LAST_TIMESTAMP = 2 ** 31 - 1
+SCAN_STEP = 6 * 60 * 60
+SWITCH_WINDOW = 60 * 60
+
+
+def get_offset(timestamp):
+    return time.localtime(timestamp).tm_gmtoff
+
+
+def find_switches():
+    """
+    Yields timestamps at which the local time zone offset changes
+    """
+    prev = FIRST_TIMESTAMP
+    for timestamp in range(FIRST_TIMESTAMP + SCAN_STEP, LAST_TIMESTAMP, SCAN_STEP):
+        if get_offset(timestamp) != get_offset(prev):
+            lo, hi = prev, timestamp
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if get_offset(mid) == get_offset(lo):
+                    lo = mid
+                else:
+                    hi = mid
+            yield hi
+        prev = timestamp
+
+
+def check(timestamp):
+    expected = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
+    actual = utils.fmt_timestamp(timestamp)
+    if actual != expected:
+        raise RuntimeError('%s: fmt_timestamp(%s) is %s, expected %s' % (os.environ['TZ'], timestamp, actual, expected))
+
+
+def check_zone(zone, samples, rnd):
+    os.environ['TZ'] = zone
+    time.tzset()
+    utils.get_timestamp_bucket.cache_clear()
+
+    switches = list(find_switches())
+    for switch in switches:
+        for timestamp in range(switch - SWITCH_WINDOW, switch + SWITCH_WINDOW):
+            check(timestamp)
+    for _ in range(samples):
+        check(rnd.randint(FIRST_TIMESTAMP, LAST_TIMESTAMP))
+    return len(switches)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--zones', default=','.join(DEFAULT_ZONES))
+    parser.add_argument('--all-zones', default=False, action='store_true', help="Check all zones known to zoneinfo")
+    parser.add_argument('--samples', default=100000, type=int, help="Number of random timestamps checked in each zone")
+    parser.add_argument('--seed', default=1, type=int)
+    args = parser.parse_args()
+
+    if args.all_zones:
+        import zoneinfo
+        zones = sorted(zoneinfo.available_timezones())
+    else:
+        zones = args.zones.split(',')
+
+    rnd = random.Random(args.seed)
+    for zone in zones:
+        started = time.perf_counter()
+        switches = check_zone(zone, args.samples, rnd)
+        sys.stdout.write('%-24s %4d offset changes, ok (%.1fs)\n' % (zone, switches, time.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    main()
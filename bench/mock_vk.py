@@ -0,0 +1,349 @@
+"""
+Local stand-in for api.vk.com and VK CDN serving synthetic dialogs, used to benchmark the exporter without
+a real account and network.
+
+    python bench/mock_vk.py --port 8080 --messages 10000
+
+Point the exporter to it with --api-url http://127.0.0.1:8080/method/, any token is accepted.
+"""
+
+import argparse
+import functools
+import http.server
+import json
+import random
+import re
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+
+BASE_DATE = 1500000000
+CHAT_PEER_OFFSET = 2000000000
+OWNER_ID = 1
+
+# relative frequencies of attachment types, wall posts contain a photo and a repost
+DEFAULT_ATTACHMENT_MIX = {
+    'photo': 2, 'sticker': 1, 'doc': 1, 'voice': 1, 'wall': 1, 'video': 1, 'link': 1, 'gift': 1, 'audio': 1
+}
+
+
+def parse_attachment_mix(text):
+    """
+    Parses attachment mix from a string like photo=2,sticker=1
+    """
+    mix = dict()
+    for item in text.split(','):
+        kind, weight = item.split('=')
+        if kind not in DEFAULT_ATTACHMENT_MIX:
+            raise ValueError('Unknown attachment type: %s' % kind)
+        mix[kind] = int(weight)
+    return mix
+
+
+class SyntheticAccount:
+    """
+    Generates dialogs, messages and profiles. Every message is generated from its dialog and index only,
+    so all pages of history are stable between requests and runs.
+    Every third dialog is a group chat, others are dialogs with users.
+    """
+
+    def __init__(self, messages=1000, dialogs=3, attach_every=3, attachment_mix=None):
+        self.messages = messages
+        self.dialogs = dialogs
+        self.attach_every = attach_every
+        self.attachment_kinds = []
+        for kind, weight in (attachment_mix or DEFAULT_ATTACHMENT_MIX).items():
+            self.attachment_kinds += [kind] * weight
+        self.base_url = ''
+
+    def get_peers(self):
+        return [CHAT_PEER_OFFSET + index + 1 if index % 3 == 2 else 10 + index for index in range(self.dialogs)]
+
+    def cdn_url(self, kind, name, size):
+        return '%s/cdn/%s/%s?size=%s' % (self.base_url, kind, name, size)
+
+    def message(self, peer, index):
+        rnd = random.Random(peer * 1000003 + index)
+        other = peer if peer < CHAT_PEER_OFFSET else 100 + (index % 7)
+        msg = {
+            'id': index,
+            'date': BASE_DATE + index * 1000 + rnd.choice([0, 800, 950]),
+            'from_id': other if (index // 3) % 2 else OWNER_ID,
+            'user_id': other,
+            'body': 'Message %s of %s: %s' % (index, peer, ' '.join(
+                rnd.choice(['hello', 'world', 'привет', 'test', 'lorem', 'ipsum']) for _ in range(rnd.randint(1, 12)))),
+            'important': index % 97 == 0
+        }
+        if index % 13 == 0:
+            msg['update_time'] = msg['date'] + 90
+        if self.attachment_kinds and index % self.attach_every == 0:
+            msg['attachments'] = [self.attachment(rnd.choice(self.attachment_kinds), index, rnd)]
+        if index % 17 == 0:
+            msg['fwd_messages'] = [{
+                'date': BASE_DATE + index,
+                'user_id': 100 + index % 11,
+                'body': 'forwarded %s' % index,
+                'attachments': [self.attachment('photo', index + 500000, rnd)]
+            }]
+        if peer >= CHAT_PEER_OFFSET and index % 50 == 0:
+            msg['action'] = 'chat_kick_user'
+            msg['action_mid'] = 100 + index % 5
+        return msg
+
+    def attachment(self, kind, index, rnd):
+        if kind == 'photo':
+            photo_id = rnd.randint(1, 5000)
+            return {'type': 'photo', 'photo': {
+                'id': photo_id, 'owner_id': OWNER_ID, 'text': 'photo', 'date': BASE_DATE, 'width': 604, 'height': 400,
+                'photo_75': self.cdn_url('photo', 'p%s_75' % photo_id, 300),
+                'photo_604': self.cdn_url('photo', 'p%s_604' % photo_id, 4000)
+            }}
+        elif kind == 'sticker':
+            sticker_id = rnd.randint(1, 50)
+            return {'type': 'sticker', 'sticker': {'sticker_id': sticker_id, 'images': [
+                {'width': 64, 'url': self.cdn_url('sticker', 's%s_64' % sticker_id, 500)},
+                {'width': 128, 'url': self.cdn_url('sticker', 's%s_128' % sticker_id, 1500)}
+            ]}}
+        elif kind == 'doc':
+            doc_id = rnd.randint(1, 100000)
+            return {'type': 'doc', 'doc': {'id': doc_id, 'ext': 'pdf', 'title': 'doc %s' % doc_id, 'size': 20000,
+                                           'url': self.cdn_url('doc', 'd%s.pdf' % doc_id, 20000)}}
+        elif kind == 'voice':
+            voice_id = rnd.randint(1, 100000)
+            return {'type': 'doc', 'doc': {
+                'id': voice_id, 'ext': 'ogg', 'owner_id': OWNER_ID, 'date': BASE_DATE,
+                'preview': {'audio_msg': {'duration': 7, 'link_mp3': self.cdn_url('voice', 'v%s.mp3' % voice_id, 6000)}}
+            }}
+        elif kind == 'audio':
+            return {'type': 'audio', 'audio': {'id': index, 'artist': 'Artist', 'title': 'Title', 'duration': 200,
+                                               'url': self.cdn_url('audio', 'a%s.mp3' % index, 8000)}}
+        elif kind == 'video':
+            video_id = rnd.randint(1, 1000)
+            return {'type': 'video', 'video': {
+                'id': video_id, 'owner_id': -5, 'title': 'video', 'duration': 75, 'date': BASE_DATE,
+                'description': 'description', 'views': 10, 'comments': 1, 'platform': 'YouTube',
+                'photo_130': self.cdn_url('video', 'vt%s' % video_id, 900)
+            }}
+        elif kind == 'link':
+            return {'type': 'link', 'link': {
+                'url': 'https://example.com/%s' % index, 'title': 'link', 'description': 'description', 'caption': 'caption',
+                'photo': {'id': 900000 + index % 20, 'photo_130': self.cdn_url('photo', 'l%s' % (index % 20), 700)}
+            }}
+        elif kind == 'gift':
+            return {'type': 'gift', 'gift': {'id': index % 10,
+                                             'thumb_48': self.cdn_url('gift', 'g%s' % (index % 10), 400),
+                                             'thumb_256': self.cdn_url('gift', 'g%s_256' % (index % 10), 1200)}}
+
+        return {'type': 'wall', 'wall': {
+            'id': index, 'from_id': -5, 'to_id': -5, 'post_type': 'post', 'date': BASE_DATE, 'text': 'wall post %s' % index,
+            'attachments': [self.attachment('photo', index + 1, rnd)],
+            'copy_history': [{'id': index + 1, 'from_id': 7, 'to_id': 7, 'post_type': 'post', 'date': BASE_DATE,
+                              'text': 'original'}]
+        }}
+
+    def history(self, params):
+        peer = int(params['user_id']) if 'user_id' in params else int(params['peer_id'])
+        offset = int(params.get('offset', 0))
+        count = int(params.get('count', 20))
+        start_message_id = int(params.get('start_message_id', 0) or 0)
+        first = max(start_message_id, 1) + offset
+        items = [self.message(peer, index) for index in range(first, first + count) if 1 <= index <= self.messages]
+        return {'count': self.messages, 'items': items}
+
+    def dialogs_page(self, params):
+        offset = int(params.get('offset', 0))
+        count = int(params.get('count', 20))
+        items = []
+        for peer in self.get_peers():
+            if peer >= CHAT_PEER_OFFSET:
+                items.append({'message': {'chat_id': peer - CHAT_PEER_OFFSET}})
+            else:
+                items.append({'message': {'user_id': peer}})
+        return {'count': len(items), 'items': items[offset:offset + count]}
+
+    def user(self, user_id):
+        return {'id': user_id, 'first_name': 'First%s' % user_id, 'last_name': 'Last%s' % user_id,
+                'photo_50': self.cdn_url('avatar', 'u%s' % user_id, 800)}
+
+    def group(self, group_id):
+        return {'id': group_id, 'name': 'Group %s' % group_id, 'screen_name': 'club%s' % group_id,
+                'photo_50': self.cdn_url('avatar', 'g%s' % group_id, 800),
+                'photo_100': self.cdn_url('avatar', 'g%s_100' % group_id, 1600)}
+
+    def chat(self, params):
+        return {'id': int(params.get('chat_id', 0)), 'users': [self.user(100 + k) for k in range(7)] + [self.user(OWNER_ID)]}
+
+    def call(self, method, params):
+        if method == 'messages.getHistory':
+            return self.history(params)
+        elif method == 'execute':
+            calls = re.findall(r'API\.messages\.getHistory\((\{.*?\})\)', params.get('code', ''))
+            return [self.history(json.loads(call)) for call in calls]
+        elif method == 'users.get':
+            return [self.user(int(user_id)) for user_id in params['user_ids'].split(',') if user_id]
+        elif method == 'groups.getById':
+            return [self.group(int(group_id)) for group_id in params['group_ids'].split(',') if group_id]
+        elif method == 'messages.getDialogs':
+            return self.dialogs_page(params)
+        elif method == 'messages.getChat':
+            return self.chat(params)
+        raise KeyError(method)
+
+
+class MockVkServer:
+    """
+    Serves API methods under /method/ and attachment files under /cdn/. Every request is delayed by latency seconds,
+    API requests fail with "Too many requests per second" error with rate_limit_errors probability.
+    Counts API calls and bytes of files sent.
+    """
+
+    def __init__(self, account, latency=0.0, rate_limit_errors=0.0, port=0):
+        self.account = account
+        self.latency = latency
+        self.rate_limit_errors = rate_limit_errors
+        self.api_calls = 0
+        self.api_methods = dict()
+        self.api_errors = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.handle(self)
+
+            def do_POST(self):
+                server.handle(self)
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', port), Handler)
+        account.base_url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.api_url = account.base_url + '/method/'
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'api_calls': self.api_calls,
+                'api_methods': dict(self.api_methods),
+                'api_errors': self.api_errors,
+                'bytes_sent': self.bytes_sent
+            }
+
+    def handle(self, request):
+        if self.latency:
+            time.sleep(self.latency)
+
+        url = urllib.parse.urlsplit(request.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        if request.command == 'POST':
+            length = int(request.headers.get('Content-Length', 0))
+            params.update(urllib.parse.parse_qsl(request.rfile.read(length).decode('utf-8')))
+
+        if url.path.startswith('/method/'):
+            self.handle_api(request, url.path[len('/method/'):], params)
+        elif url.path.startswith('/cdn/'):
+            self.handle_file(request, url.path, params)
+        else:
+            self.send(request, 404, b'Not found', 'text/plain')
+
+    def handle_api(self, request, method, params):
+        with self.lock:
+            self.api_calls += 1
+            self.api_methods[method] = self.api_methods.get(method, 0) + 1
+
+        if self.rate_limit_errors and random.random() < self.rate_limit_errors:
+            with self.lock:
+                self.api_errors += 1
+            reply = {'error': {'error_code': 6, 'error_msg': 'Too many requests per second.'}}
+        else:
+            try:
+                reply = {'response': self.account.call(method, params)}
+            except KeyError:
+                reply = {'error': {'error_code': 3, 'error_msg': 'Unknown method passed.'}}
+
+        self.send(request, 200, json.dumps(reply).encode('utf-8'), 'application/json')
+
+    @functools.lru_cache(maxsize=64)
+    def get_file_body(self, size):
+        return bytes((index * 31 + size) % 256 for index in range(size))
+
+    def handle_file(self, request, path, params):
+        size = int(params.get('size', 2000))
+        body = self.get_file_body(size)
+        content_type = 'image/png' if path.startswith('/cdn/sticker/') else 'image/jpeg'
+
+        range_header = request.headers.get('Range', '')
+        start = int(range_header[len('bytes='):].split('-')[0]) if range_header.startswith('bytes=') else 0
+        if start >= size > 0:
+            self.send(request, 416, b'', content_type)
+            return
+
+        with self.lock:
+            self.bytes_sent += size - start
+        if start > 0:
+            self.send(request, 206, body[start:], content_type, {'Content-Range': 'bytes %s-%s/%s' % (start, size - 1, size)})
+        else:
+            self.send(request, 200, body, content_type)
+
+    def send(self, request, status, body, content_type, headers=None):
+        request.send_response(status)
+        request.send_header('Content-Type', content_type)
+        request.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or dict()).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(body)
+
+
+def add_account_arguments(parser):
+    parser.add_argument('--messages', dest='messages', default=1000, type=int, help="Number of messages in each dialog")
+    parser.add_argument('--dialogs', dest='dialogs', default=3, type=int, help="Number of dialogs")
+    parser.add_argument('--attach-every', dest='attach_every', default=3, type=int,
+                        help="Every message with index divisible by this number has an attachment")
+    parser.add_argument('--attachments', dest='attachments', default=None, type=parse_attachment_mix,
+                        help="Relative frequencies of attachment types, like photo=2,sticker=1,doc=1")
+    parser.add_argument('--latency', dest='latency', default=0.0, type=float, help="Delay of each response in seconds")
+    parser.add_argument('--rate-limit-errors', dest='rate_limit_errors', default=0.0, type=float,
+                        help="Probability of an API request failing with a rate limit error")
+
+
+def create_server(arguments, port=0):
+    account = SyntheticAccount(arguments.messages, arguments.dialogs, arguments.attach_every, arguments.attachments)
+    return MockVkServer(account, arguments.latency, arguments.rate_limit_errors, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a local mock of VK API serving synthetic dialogs")
+    parser.add_argument('--port', dest='port', default=8080, type=int, help="Port to listen on")
+    add_account_arguments(parser)
+    arguments = parser.parse_args()
+
+    server = create_server(arguments, arguments.port)
+    sys.stdout.write('Serving VK API at %s\n' % server.api_url)
+    try:
+        server.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
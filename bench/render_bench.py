@@ -0,0 +1,136 @@
+"""
+Measures HTML rendering throughput on a synthetic dialog. Compiled templates are compared with formatting
+template sources with str.format and merged dicts, the way messages were rendered before templates were compiled.
+
+    python bench/render_bench.py [--messages 100000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import html_exporter
+from template import Template
+
+
+class FormatTemplate:
+    def __init__(self, template):
+        self.source = template.source
+
+    def render(self, values=None, **extra):
+        return self.source.format(**{**(values or {}), **extra})
+
+
+def make_users(count):
+    return dict((user_id, {
+        'name': 'First%s Last%s' % (user_id, user_id),
+        'first_name': 'First%s' % user_id,
+        'last_name': 'Last%s' % user_id,
+        'link': 'https://vk.com/id%s' % user_id,
+        'filename': 'avatars/%s.jpg' % user_id
+    }) for user_id in range(1, count + 1))
+
+
+def make_attachment(rnd, index, depth=0):
+    kind = rnd.choice(['photo', 'photo', 'sticker', 'doc', 'video', 'audio', 'voice', 'link', 'post'])
+    if kind == 'photo':
+        return {'type': 'photo', 'filename': '10/%s.jpg' % index, 'url': 'photo_604', 'description': '',
+                'owner_id': 1, 'width': 604, 'height': 453, 'date': 1500000000 + index, 'id': index, 'album_id': 0}
+    elif kind == 'sticker':
+        return {'type': 'sticker', 'filename': 'stickers/%s_128.png' % (index % 50), 'url': ''}
+    elif kind == 'doc':
+        return {'type': 'doc', 'filename': '10/%s.pdf' % index, 'url': 'https://vk.com/doc', 'title': 'doc %s' % index,
+                'size': 20000 + index, 'ext': 'pdf'}
+    elif kind == 'video':
+        return {'type': 'video', 'description': 'video', 'url': 'https://vk.com/video1_%s' % index, 'title': 'Video',
+                'duration': index % 3600, 'views': 10, 'comments': 1, 'thumbnail_filename': '10/%s.jpg' % index,
+                'platform': 'YouTube', 'date': 1500000000 + index, 'owner_id': 1}
+    elif kind == 'audio':
+        return {'type': 'audio', 'artist': 'Artist', 'title': 'Title', 'duration': index % 600, 'filename': None,
+                'url': ''}
+    elif kind == 'voice':
+        return {'type': 'voice', 'filename': '10/%s.ogg' % index, 'url': '', 'duration': index % 60, 'id': index,
+                'owner_id': 1, 'date': 1500000000 + index}
+    elif kind == 'link':
+        return {'type': 'link', 'url': 'https://example.com', 'title': 'Example', 'caption': 'example.com',
+                'description': 'Example page', 'filename': None}
+
+    post = {'type': 'post', 'from_id': 2, 'to_id': 2, 'post_type': 'post', 'date': 1500000000 + index,
+            'text': 'Post text ' * 10, 'url': 'https://vk.com/wall2_%s' % index, 'views': 100, 'likes': 10,
+            'comments': 1, 'reposts': 0, 'source': {'type': 'api', 'platform': 'unknown'}}
+    if depth == 0:
+        post['attachments'] = [make_attachment(rnd, index, depth + 1)]
+    return post
+
+
+def make_messages(count, seed=1):
+    rnd = random.Random(seed)
+    date = 1500000000
+    messages = []
+    for index in range(count):
+        date += rnd.choice([10, 100, 1000, 100000])
+        msg = {
+            'id': index + 1,
+            'date': date,
+            'message': ' '.join(rnd.choice(['hello', 'world', 'lorem', 'ipsum', 'привет']) for _ in range(rnd.randint(1, 30))),
+            'is_important': index % 50 == 0,
+            'is_updated': index % 20 == 0,
+            'sender': {'id': rnd.randint(1, 10)}
+        }
+        if msg['is_updated']:
+            msg['updated_at'] = date + 300
+        if index % 3 == 0:
+            msg['attachments'] = [make_attachment(rnd, index) for _ in range(rnd.randint(1, 3))]
+        if index % 25 == 0:
+            msg['forwarded'] = [dict(msg, sender={'id': 1}), dict(msg, sender={'id': 2})]
+        messages.append(msg)
+    return messages
+
+
+def render_all(messages, users):
+    options = types.SimpleNamespace(arguments=types.SimpleNamespace(save_json_in_html=False, embed_resources=False),
+                                    html_split=None, output_dir='.')
+    exporter = html_exporter.HTMLExporter(options)
+    output = []
+    ctx = html_exporter.HTMLExporterContext(None, types.SimpleNamespace(append=output.append), users, 1)
+
+    started_at = time.perf_counter()
+    for msg in messages:
+        ctx.output.append(exporter.export_message(ctx, msg))
+    elapsed = time.perf_counter() - started_at
+    return elapsed, sum(len(text) for text in output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks rendering of HTML output")
+    parser.add_argument('--messages', dest='messages', default=100000, type=int, help="Number of messages to render")
+    arguments = parser.parse_args()
+
+    messages = make_messages(arguments.messages)
+    users = make_users(10)
+
+    compiled_time, compiled_size = render_all(messages, users)
+
+    templates = dict((name, value) for name, value in vars(html_exporter).items() if isinstance(value, Template))
+    for name, template in templates.items():
+        setattr(html_exporter, name, FormatTemplate(template))
+    try:
+        format_time, format_size = render_all(messages, users)
+    finally:
+        for name, template in templates.items():
+            setattr(html_exporter, name, template)
+
+    sys.stdout.write('%s messages\n' % len(messages))
+    for title, elapsed, size in (('str.format', format_time, format_size), ('compiled', compiled_time, compiled_size)):
+        sys.stdout.write('%-12s %8.2f sec %10.0f msg/s %10.1f MiB\n'
+                         % (title, elapsed, len(messages) / elapsed, size / 1024 / 1024))
+    sys.stdout.write('speedup      %8.2fx\n' % (format_time / compiled_time))
+
+
+if __name__ == '__main__':
+    main()
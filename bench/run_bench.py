@@ -0,0 +1,200 @@
+"""
+Exports synthetic dialogs served by a local mock of VK API and reports throughput of each stage:
+
+    fetch  -- fetching history, resolving users and downloading attachments (dialogs are saved in JSON Lines format)
+    json   -- writing fetched messages in JSON format
+    html   -- writing fetched messages in HTML format
+
+Each stage runs in a separate process, so peak memory usage is measured for each stage separately.
+
+    python bench/run_bench.py --messages 10000 --dialogs 3 -- --docs --audio
+
+Arguments after -- are passed to the exporter in the fetch stage.
+"""
+
+import argparse
+import codecs
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from mock_vk import *
+
+
+STAGES = ['fetch', 'json', 'html']
+
+
+def get_peak_rss():
+    """
+    Returns peak resident set size of the current process in bytes, or None if it is not available
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run_fetch(api_url, out_dir, export_args):
+    from api import VkApi
+    from exporter import DialogExporter, progress
+    from export_jobs import export_dialog, open_blob_store, open_profile_cache
+    from options import Options
+
+    options = Options(['--out', out_dir, '--format', 'jsonl', '--api-url', api_url] + export_args)
+    VkApi.token = 'token'
+    VkApi.user_id = str(OWNER_ID)
+    VkApi.base_url = api_url
+    VkApi.rate_limiter.rate = options.arguments.api_rate
+    api = VkApi()
+    profile_cache = open_profile_cache(options)
+    blob_store = open_blob_store(options)
+
+    dialogs = []
+    for dialog in api.call('messages.getDialogs', [('offset', 0), ('count', 200)])['items']:
+        if 'chat_id' in dialog['message']:
+            dialogs.append(('chat', dialog['message']['chat_id']))
+        else:
+            dialogs.append(('user', dialog['message']['user_id']))
+
+    messages = 0
+    progress.total_stages = len(dialogs)
+    for dlg_type, dlg_id in dialogs:
+        exp = DialogExporter(api, dlg_type, dlg_id, options, profile_cache, blob_store)
+        export_dialog(exp, options)
+        messages += exp.message_count
+        progress.next_stage()
+    return messages
+
+
+def read_fixture(fetch_dir):
+    """
+    Reads dialogs saved by the fetch stage, yields dialog id, messages and users of each dialog
+    """
+    for filename in sorted(os.listdir(fetch_dir)):
+        if not filename.endswith('.jsonl'):
+            continue
+        dialog_id = filename[:-len('.jsonl')]
+        with codecs.open(os.path.join(fetch_dir, dialog_id + '.users.json'), 'r', encoding='utf-8') as f:
+            users = dict((int(user_id), user) for user_id, user in json.load(f).items())
+        with codecs.open(os.path.join(fetch_dir, filename), 'r', encoding='utf-8') as f:
+            messages = [json.loads(line) for line in f]
+        yield dialog_id, messages, users
+
+
+def run_render(stage, fetch_dir, out_dir):
+    from dialog_state import DialogState
+    from exporter import progress
+    from export_jobs import create_format_exporter
+    from options import Options
+
+    options = Options(['--out', out_dir, '--format', stage])
+    fixture = list(read_fixture(fetch_dir))
+
+    started_at = time.perf_counter()
+    messages = 0
+    for dialog_id, dialog_messages, users in fixture:
+        format_exporter = create_format_exporter(options)
+        state = DialogState(DialogState.get_filename(out_dir, dialog_id, format_exporter.extension))
+        format_exporter.begin(dialog_id, progress, state, False)
+        for msg in dialog_messages:
+            format_exporter.write_message(msg, users)
+        format_exporter.end(users)
+        messages += len(dialog_messages)
+    return messages, time.perf_counter() - started_at
+
+
+def run_stage(arguments, export_args):
+    """
+    Runs a single stage in this process and saves its results into a file
+    """
+    fetch_dir = os.path.join(arguments.work_dir, 'fetch')
+    out_dir = os.path.join(arguments.work_dir, arguments.stage)
+    if arguments.stage == 'fetch':
+        started_at = time.perf_counter()
+        messages = run_fetch(arguments.api_url, fetch_dir, export_args)
+        elapsed = time.perf_counter() - started_at
+    else:
+        messages, elapsed = run_render(arguments.stage, fetch_dir, out_dir)
+
+    with open(arguments.result, 'w', encoding='utf-8') as f:
+        json.dump({'messages': messages, 'seconds': elapsed, 'peak_rss': get_peak_rss()}, f)
+
+
+def fmt_bytes(size):
+    if size is None:
+        return '?'
+    return '%.1f MiB' % (size / 1024 / 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the exporter against a local mock of VK API")
+    add_account_arguments(parser)
+    parser.add_argument('--stages', dest='stages', default=','.join(STAGES), type=str,
+                        help="Comma separated list of stages to run: %s" % ', '.join(STAGES))
+    parser.add_argument('--work-dir', dest='work_dir', default=None, type=str,
+                        help="Directory for exported files, a temporary directory is used and removed by default")
+    parser.add_argument('--stage', dest='stage', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--api-url', dest='api_url', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result', dest='result', default=None, help=argparse.SUPPRESS)
+    arguments, export_args = parser.parse_known_args()
+    export_args = [arg for arg in export_args if arg != '--']
+    if '--api-rate' not in export_args:
+        # the mock has no rate limit
+        export_args += ['--api-rate', '1000']
+
+    if arguments.stage is not None:
+        run_stage(arguments, export_args)
+        return
+
+    stages = arguments.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error('Unknown stage: %s' % stage)
+
+    work_dir = arguments.work_dir or tempfile.mkdtemp(prefix='vk-bench-')
+    server = create_server(arguments).start()
+    results = []
+    try:
+        for stage in stages:
+            result_filename = os.path.join(work_dir, '%s.result.json' % stage)
+            stats_before = server.get_stats()
+            command = [sys.executable, os.path.abspath(__file__), '--stage', stage, '--api-url', server.api_url,
+                       '--work-dir', work_dir, '--result', result_filename] + export_args
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            stats_after = server.get_stats()
+
+            with open(result_filename, 'r', encoding='utf-8') as f:
+                result = json.load(f)
+            result.update({
+                'stage': stage,
+                'api_calls': stats_after['api_calls'] - stats_before['api_calls'],
+                'bytes_downloaded': stats_after['bytes_sent'] - stats_before['bytes_sent']
+            })
+            results.append(result)
+    finally:
+        server.stop()
+        if arguments.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    sys.stdout.write('%-6s %10s %10s %12s %10s %14s %12s\n'
+                     % ('stage', 'messages', 'seconds', 'messages/s', 'API calls', 'downloaded', 'peak RSS'))
+    for result in results:
+        sys.stdout.write('%-6s %10s %10.2f %12.0f %10s %14s %12s\n' % (
+            result['stage'], result['messages'], result['seconds'],
+            result['messages'] / result['seconds'] if result['seconds'] > 0 else 0,
+            result['api_calls'], fmt_bytes(result['bytes_downloaded']), fmt_bytes(result['peak_rss'])))
+
+
+if __name__ == '__main__':
+    main()
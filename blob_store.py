@@ -0,0 +1,77 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+
+BLOB_STORE_DIRNAME = '.blobs'
+BLOB_STORE_DB_FILENAME = 'blobs.sqlite'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# attachments are stored once under their sha256 hashes, files in dialog directories are hardlinks to blobs, or dialogs
+# refer to blobs directly when hardlinks are not supported
+class BlobStore:
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.blobs_dir = os.path.join(output_dir, BLOB_STORE_DIRNAME)
+        # downloads are added from several threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(output_dir, BLOB_STORE_DB_FILENAME), timeout=60,
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS attachments (url TEXT PRIMARY KEY, blob TEXT NOT NULL)')
+        self.db.commit()
+
+    def get_blob_path(self, blob):
+        return os.path.join(self.blobs_dir, blob[:2], blob)
+
+    def find(self, url):
+        with self.lock:
+            row = self.db.execute('SELECT blob FROM attachments WHERE url = ?', (url,)).fetchone()
+        if row is None or not os.path.exists(self.get_blob_path(row[0])):
+            return None
+        return row[0]
+
+    def link(self, blob, abs_out_path):
+        # returns the path relative to the output directory the attachment should be referred by
+        blob_path = self.get_blob_path(blob)
+        try:
+            if os.path.exists(abs_out_path):
+                os.remove(abs_out_path)
+            os.link(blob_path, abs_out_path)
+            return os.path.relpath(abs_out_path, self.output_dir)
+        except OSError:
+            return os.path.relpath(blob_path, self.output_dir)
+
+    def add(self, url, abs_path):
+        # moves a downloaded file into the store and replaces it with a link to the blob
+        blob = hash_file(abs_path) + os.path.splitext(abs_path)[1]
+        blob_path = self.get_blob_path(blob)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        if not os.path.exists(blob_path):
+            try:
+                os.link(abs_path, blob_path)
+            except FileExistsError:
+                pass  # the same file has just been stored by another thread or process
+            except OSError:
+                os.replace(abs_path, blob_path)
+
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO attachments (url, blob) VALUES (?, ?)', (url, blob))
+
+        if os.path.exists(abs_path) and os.path.samefile(abs_path, blob_path):
+            return os.path.relpath(abs_path, self.output_dir)
+        return self.link(blob, abs_path)
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,39 @@
+import json
+import os
+
+
+# how far a dialog has been exported, each output format keeps data it needs to resume writing in output
+class DialogState:
+    def __init__(self, filename):
+        self.filename = filename
+        self.last_message_id = 0
+        self.message_count = 0
+        self.output = dict()
+
+    @staticmethod
+    def get_filename(output_dir, dialog_id, extension):
+        return os.path.join(output_dir, '%s.%s.state.json' % (dialog_id, extension))
+
+    @classmethod
+    def load(cls, filename):
+        state = cls(filename)
+        if os.path.exists(filename):
+            with open(filename, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            state.last_message_id = data.get('last_message_id', 0)
+            state.message_count = data.get('message_count', 0)
+            state.output = data.get('output', dict())
+        return state
+
+    def save(self):
+        data = {
+            'last_message_id': self.last_message_id,
+            'message_count': self.message_count,
+            'output': self.output
+        }
+
+        # state should never be left half-written, otherwise next export appends to a wrong place
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(temp_filename, self.filename)
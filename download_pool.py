@@ -0,0 +1,80 @@
+import concurrent.futures
+import multiprocessing
+import threading
+import zlib
+
+
+DOWNLOAD_LOCKS_COUNT = 64
+
+
+# placeholder for a file being downloaded in background, resolve_downloads replaces it with the filename
+class PendingDownload:
+    def __init__(self, future):
+        self.future = future
+
+    def result(self):
+        return self.future.result()
+
+
+class DownloadPool:
+    def __init__(self, workers):
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self.in_flight = dict()
+        self.lock = threading.Lock()
+
+    @property
+    def backlog(self):
+        # how many exported messages we can hold while their attachments are being downloaded
+        return self.workers * 16
+
+    def submit(self, key, func, *args):
+        if self.executor is None:
+            return func(*args)
+
+        with self.lock:
+            pending = self.in_flight.get(key)
+            if pending is not None:
+                # the same file can be requested several times before the first download finishes
+                return pending
+            pending = PendingDownload(self.executor.submit(func, *args))
+            self.in_flight[key] = pending
+
+        # callback is called immediately if the download has already finished, so it should be added without the lock
+        pending.future.add_done_callback(lambda f: self._forget(key, pending))
+        return pending
+
+    def _forget(self, key, pending):
+        with self.lock:
+            if self.in_flight.get(key) is pending:
+                del self.in_flight[key]
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+
+# locks shared by worker processes, each file path is mapped to one of them
+class DownloadLocks:
+    def __init__(self, count=DOWNLOAD_LOCKS_COUNT):
+        self.locks = [multiprocessing.Lock() for _ in range(count)]
+
+    def get(self, path):
+        return self.locks[zlib.crc32(path.encode('utf-8')) % len(self.locks)]
+
+
+def resolve_downloads(obj):
+    # waits for downloads and replaces placeholders with filenames in place
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if isinstance(v, PendingDownload):
+                obj[k] = v.result()
+            elif isinstance(v, (dict, list)):
+                resolve_downloads(v)
+    elif isinstance(obj, list):
+        for index, v in enumerate(obj):
+            if isinstance(v, PendingDownload):
+                obj[index] = v.result()
+            elif isinstance(v, (dict, list)):
+                resolve_downloads(v)
+    return obj
@@ -0,0 +1,152 @@
+import multiprocessing
+import os
+from api import *
+from blob_store import *
+from dialog_state import *
+from exporter import *
+from html_exporter import *
+from http_pool import http_pool
+from json_exporter import *
+from metrics import metrics
+from profile_cache import *
+from profiling import *
+from sqlite_exporter import *
+
+
+def create_format_exporter(options):
+    if options.output_format == 'json':
+        return JSONExporter(options)
+    elif options.output_format == 'jsonl':
+        return JSONLinesExporter(options)
+    elif options.output_format == 'html':
+        return HTMLExporter(options)
+    elif options.output_format == 'sqlite':
+        return SQLiteExporter(options)
+    else:
+        raise RuntimeError("Unknown format")
+
+
+def open_profile_cache(options):
+    if options.arguments.profile_cache_ttl <= 0:
+        return None
+    return ProfileCache(os.path.join(options.output_dir, PROFILE_CACHE_FILENAME),
+                        options.arguments.profile_cache_ttl * 60 * 60)
+
+
+def open_blob_store(options):
+    if not options.arguments.dedup:
+        return None
+    return BlobStore(options.output_dir)
+
+
+def prepare_shared_databases(options):
+    # switching to WAL needs an exclusive lock, workers doing it at once fail with "database is locked"
+    for db in [open_profile_cache(options), open_blob_store(options)]:
+        if db is not None:
+            db.close()
+    if options.output_format == 'sqlite':
+        SQLiteExporter(options).open_database().close()
+
+
+def finish_dialog(exp, format_exporter, state, users):
+    with metrics.timer('stage.finish'):
+        format_exporter.end(users)
+
+    state.last_message_id = max(state.last_message_id, exp.last_message_id)
+    state.message_count += exp.message_count
+    state.save()
+
+
+def export_dialog(exp, options):
+    # returns metrics collected while exporting the dialog
+    metrics.start_dialog()
+    format_exporter = create_format_exporter(options)
+
+    state = DialogState.load(DialogState.get_filename(options.output_dir, exp.id, format_exporter.extension))
+    resume = options.arguments.incremental and state.last_message_id > 0 \
+        and os.path.exists(format_exporter.get_filename(exp.id)) and format_exporter.can_resume(state)
+    if resume:
+        exp.start_message_id = state.last_message_id
+        exp.exported_count = state.message_count
+    else:
+        # the output is going to be rewritten, the old state must not survive an interrupted export, otherwise
+        # the next incremental export would append messages at an offset of the old file
+        state = DialogState(state.filename)
+        state.save()
+
+    format_exporter.begin(exp.id, progress, state, resume)
+    if options.arguments.profile:
+        profiler = DialogProfiler()
+        with profiler.stage('export'):
+            users = exp.export(profiler.wrap_writer(format_exporter))
+        with profiler.stage('finish'):
+            finish_dialog(exp, format_exporter, state, users)
+        profiler.save(options.output_dir, exp.id)
+    else:
+        users = exp.export(format_exporter)
+        finish_dialog(exp, format_exporter, state, users)
+
+    dialog_metrics = metrics.finish_dialog(exp.id)
+    if options.arguments.metrics:
+        metrics.save_dialog(options.output_dir, exp.id, dialog_metrics)
+    return dialog_metrics
+
+
+# state of a worker process, set up once by init_worker
+worker_api = None
+worker_options = None
+worker_profile_cache = None
+worker_blob_store = None
+worker_download_locks = None
+
+
+def init_worker(token, user_id, rate_limiter, download_locks, options):
+    global worker_api, worker_options, worker_profile_cache, worker_blob_store, worker_download_locks
+
+    progress.quiet = True
+    VkApi.token = token
+    VkApi.user_id = user_id
+    VkApi.rate_limiter = rate_limiter
+    VkApi.base_url = options.arguments.api_url
+    http_pool.size = options.arguments.http_pool_size
+    # a forked worker inherits connections opened by the main process, they can not be used by two processes at once
+    http_pool.clear()
+
+    worker_api = VkApi()
+    worker_options = options
+    worker_profile_cache = open_profile_cache(options)
+    worker_blob_store = open_blob_store(options)
+    worker_download_locks = download_locks
+
+
+def export_dialog_in_worker(dialog):
+    dlg_type, dlg_id = dialog
+    exp = DialogExporter(worker_api, dlg_type, dlg_id, worker_options, worker_profile_cache,
+                         worker_blob_store, worker_download_locks)
+    try:
+        dialog_metrics = export_dialog(exp, worker_options)
+    except Exception as error:
+        # exceptions are sent back to the main process, make sure the user can see which dialog has failed
+        raise RuntimeError('Failed to export dialog %s (%s)' % (exp.id, str(error)))
+    return exp.id, dialog_metrics
+
+
+def export_dialogs_parallel(api, dialogs, options, jobs):
+    # workers share the API rate limit and the profile cache and send metrics of their dialogs back
+    prepare_shared_databases(options)
+    rate_limiter = api.rate_limiter.share()
+    download_locks = DownloadLocks()
+
+    progress.total_stages = 1
+    progress.unit = 'dialogs'
+    with multiprocessing.Pool(jobs, init_worker, (api.token, api.user_id, rate_limiter, download_locks, options)) as pool:
+        done = 0
+        progress.update(done, len(dialogs))
+        for dialog_id, dialog_metrics in pool.imap_unordered(export_dialog_in_worker, dialogs):
+            metrics.add_dialog(dialog_id, dialog_metrics)
+            done += 1
+            metrics.set_gauge('queue.dialogs_left', len(dialogs) - done)
+            progress.step_msg('Exported dialog %s' % dialog_id)
+            progress.update(done, len(dialogs))
+    progress.clear_step_msg()
+    progress.next_stage()
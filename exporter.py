@@ -1,10 +1,33 @@
+import collections
+import hashlib
+import json
 import os
-import urllib
+import urllib.error
+import urllib.parse
+from download_pool import *
+from file_index import *
+from http_pool import http_pool
+from metrics import metrics
 from progress import *
+from retry import *
 from utils import *
 
 
 USER_ACTIONS = ['chat_kick_user', 'chat_pin_message', 'chat_unpin_message']
+HISTORY_PAGE_SIZE = 200
+EXECUTE_MAX_CALLS = 25  # VK limits the number of API calls inside a single execute request
+USERS_GET_MAX_IDS = 1000
+GROUPS_GET_MAX_IDS = 500
+DOWNLOAD_RETRY_COUNT = 5
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# stickers and avatars repeat across dialogs, so they are downloaded into directories shared by all dialogs
+STICKERS_DIR = 'stickers'
+AVATARS_DIR = 'avatars'
+
+
+download_retry_policy = RetryPolicy(DOWNLOAD_RETRY_COUNT, 0.5, 10)
+# stop downloading from a CDN host for a minute after 10 consecutive failed requests to it
+download_breakers = CircuitBreakers(10, 60)
 
 
 class ExportContext:
@@ -17,66 +40,137 @@ class ExportContext:
         if user_id and user_id not in self.users:
             self.users[user_id] = self.user_fetcher.get_data(user_id, exporter)
 
+    def prefetch_users(self, user_ids, exporter=None):
+        self.user_fetcher.prefetch([user_id for user_id in user_ids if user_id not in self.users], exporter)
+
     def next_level(self):
         return ExportContext(self.user_fetcher, self.depth, self.users)
 
 
 class UserFetcher:
-    def __init__(self, api):
+    def __init__(self, api, profile_cache=None):
         self.api = api
+        self.profile_cache = profile_cache
         self.cache = dict()
+        # profiles with avatars that are still being downloaded
+        self.pending = []
 
     def get_data(self, user_id, exporter=None):
         if not (user_id in self.cache):
-            if user_id < 0:
-                groups = self.api.call("groups.getById", [("group_id", str(-user_id))])
-                data = groups[0]
-
-                downloaded = None
-                if exporter is not None:
-                    downloaded = exporter.download_image(data)
-
-                self.cache[user_id] = {
-                    'name': data['name'],
-                    'first_name': data['name'],
-                    'last_name': '',
-                    'link': 'https://vk.com/%s' % data['screen_name'],
-                    'filename': downloaded
-                }
-            else:
-                users = self.api.call("users.get", [("user_ids", str(user_id)), ("fields", "photo_50")])
-                data = users[0]
-
-                downloaded = None
-                if exporter is not None:
-                    downloaded = exporter.download_image(data)
-
-                self.cache[user_id] = {
-                    'name': '%s %s' % (data['first_name'], data['last_name']),
-                    'first_name': data['first_name'],
-                    'last_name': data['last_name'],
-                    'link': 'https://vk.com/id%s' % data['id'],
-                    'filename': downloaded
-                }
+            self.prefetch([user_id], exporter)
+            if not (user_id in self.cache):
+                raise RuntimeError('Failed to get information about user or group %s' % user_id)
         return self.cache[user_id]
 
+    def prefetch(self, user_ids, exporter=None):
+        # resolves unknown ids with as few API calls as possible, group ids are negative
+        unknown_users = sorted(set(user_id for user_id in user_ids if user_id and user_id > 0 and user_id not in self.cache))
+        unknown_groups = sorted(set(-user_id for user_id in user_ids if user_id and user_id < 0 and user_id not in self.cache))
+
+        if self.profile_cache is not None:
+            cached = self.profile_cache.get_many(unknown_users + [-group_id for group_id in unknown_groups])
+            metrics.count('profile_cache.hits', len(cached))
+            for user_id, data in cached.items():
+                if user_id > 0:
+                    self.add_user(data, exporter)
+                else:
+                    self.add_group(data, exporter)
+            unknown_users = [user_id for user_id in unknown_users if user_id not in cached]
+            unknown_groups = [group_id for group_id in unknown_groups if -group_id not in cached]
+
+        fetched = dict()
+        if self.profile_cache is not None:
+            metrics.count('profile_cache.misses', len(unknown_users) + len(unknown_groups))
+
+        for chunk in chunks(unknown_users, USERS_GET_MAX_IDS):
+            users = self.api.call("users.get", [("user_ids", ','.join(map(str, chunk))), ("fields", "photo_50")])
+            for data in users:
+                self.add_user(data, exporter)
+                fetched[data['id']] = data
+
+        for chunk in chunks(unknown_groups, GROUPS_GET_MAX_IDS):
+            groups = self.api.call("groups.getById", [("group_ids", ','.join(map(str, chunk)))])
+            for data in groups:
+                self.add_group(data, exporter)
+                fetched[-data['id']] = data
+
+        if self.profile_cache is not None and fetched:
+            self.profile_cache.put_many(fetched)
+
+    def resolve_pending(self):
+        for profile in self.pending:
+            resolve_downloads(profile)
+        self.pending = []
+
+    def add_user(self, data, exporter=None):
+        downloaded = None
+        if exporter is not None:
+            downloaded = exporter.download_avatar(data)
+
+        self.cache[data['id']] = {
+            'name': '%s %s' % (data['first_name'], data['last_name']),
+            'first_name': data['first_name'],
+            'last_name': data['last_name'],
+            'link': 'https://vk.com/id%s' % data['id'],
+            'filename': downloaded
+        }
+
+        if isinstance(downloaded, PendingDownload):
+            self.pending.append(self.cache[data['id']])
+
+    def add_group(self, data, exporter=None):
+        downloaded = None
+        if exporter is not None:
+            downloaded = exporter.download_avatar(data)
+
+        self.cache[-data['id']] = {
+            'name': data['name'],
+            'first_name': data['name'],
+            'last_name': '',
+            'link': 'https://vk.com/%s' % data['screen_name'],
+            'filename': downloaded
+        }
+
+        if isinstance(downloaded, PendingDownload):
+            self.pending.append(self.cache[-data['id']])
+
 
 progress = Progress()
 
 
+class IncompleteDownloadError(ConnectionError):
+    # a connection error, so the download is retried
+    pass
+
+
+def get_response_size(headers, offset):
+    # size of the whole file from the response, read() returns b'' when the connection is closed early,
+    # so a truncated body can only be told from a complete one by its length
+    total = headers.get('Content-Range', '').rpartition('/')[2]
+    if total.isdigit():
+        return int(total)
+    length = headers.get('Content-Length', '')
+    return offset + int(length) if length.isdigit() else -1
+
+
 class DialogExporter:
-    def __init__(self, api, dlg_type, dlg_id, options):
+    def __init__(self, api, dlg_type, dlg_id, options, profile_cache=None, blob_store=None, download_locks=None):
         self.api = api
         self.type = dlg_type
         self.id = dlg_id
         self.attach_dir = str(self.id)
         self.output_dir = options.output_dir
         self.options = options
-        self.user_fetcher = UserFetcher(api)
+        self.user_fetcher = UserFetcher(api, profile_cache)
+        self.download_pool = None
+        self.blob_store = blob_store
+        self.download_locks = download_locks
 
-        self.json_out = {
-            'messages': []
-        }
+        # when exporting incrementally, only messages newer than start_message_id are fetched
+        self.start_message_id = 0
+        self.exported_count = 0
+        self.last_message_id = 0
+        self.message_count = 0
 
     def find_largest(self, obj, key_override='photo_'):
         def get_photo_keys():
@@ -86,26 +180,73 @@ class DialogExporter:
 
         return "%s%s" % (key_override, max(map(lambda k: int(k), get_photo_keys())))
 
-    def download_file(self, url, out_filename, auto_image_ext=False, size=-1):
+    def download_file(self, url, out_filename, auto_image_ext=False, size=-1, attach_dir=None):
         if not url:
             # blocked documents or audio files go here
             return None
 
-        abs_attach_dir = os.path.join(self.output_dir, self.attach_dir)
-        if not os.path.exists(abs_attach_dir):
-            os.makedirs(abs_attach_dir)
-        elif not os.path.isdir(abs_attach_dir):
-            raise OSError("Unable to create attachments directory %s" % abs_attach_dir)
+        attach_dir = attach_dir or self.attach_dir
+        if self.download_pool is None:
+            return self._download_file(url, out_filename, auto_image_ext, size, attach_dir)
+
+        pending = self.download_pool.submit(os.path.join(attach_dir, out_filename), self._download_file,
+                                            url, out_filename, auto_image_ext, size, attach_dir)
+        metrics.set_gauge('queue.downloads_in_flight', len(self.download_pool.in_flight))
+        return pending
+
+    def _download_file(self, url, out_filename, auto_image_ext, size, attach_dir):
+        if attach_dir == self.attach_dir or self.download_locks is None:
+            return self._download_file_unlocked(url, out_filename, auto_image_ext, size, attach_dir)
 
-        rel_out_path = esc("%s/%s" % (self.attach_dir, out_filename))
+        # workers exporting other dialogs download files into shared directories too and would write the same part
+        # file at once. The file is looked up again after the lock is taken, so the worker that waited reuses it
+        with self.download_locks.get(os.path.join(attach_dir, out_filename)):
+            return self._download_file_unlocked(url, out_filename, auto_image_ext, size, attach_dir)
+
+    def _download_file_unlocked(self, url, out_filename, auto_image_ext, size, attach_dir):
+        file_index = file_indexes.get(os.path.join(self.output_dir, attach_dir))
+
+        rel_out_path = esc("%s/%s" % (attach_dir, out_filename))
         abs_out_path = os.path.join(self.output_dir, rel_out_path)
         has_ext = len(os.path.splitext(rel_out_path)[1]) > 0
-        if has_ext and os.path.exists(abs_out_path) and os.stat(abs_out_path).st_size > 0:
-            return rel_out_path  # file was already downloaded?
-        elif not has_ext and auto_image_ext:
-            downloaded_image = has_downloaded_image(abs_attach_dir, out_filename)
-            if downloaded_image is not None:
-                return os.path.join(self.attach_dir, downloaded_image)
+
+        def find_downloaded():
+            name = os.path.basename(abs_out_path)
+            if has_ext and file_index.has_file(name):
+                return rel_out_path
+            elif not has_ext and auto_image_ext:
+                downloaded_image = file_index.find_by_stem(name)
+                if downloaded_image is not None:
+                    return os.path.join(attach_dir, downloaded_image)
+            return None
+
+        def refresh_shared():
+            # files in shared directories could have been downloaded by another worker process after the directory
+            # was listed by this one
+            name = os.path.basename(abs_out_path)
+            file_index.refresh([name] if has_ext else ['%s.%s' % (name, ext) for ext in IMAGE_EXTENSIONS])
+            return find_downloaded()
+
+        downloaded = find_downloaded()
+        if downloaded is None and attach_dir != self.attach_dir and (has_ext or auto_image_ext):
+            downloaded = refresh_shared()
+        if downloaded is not None:
+            metrics.count('downloads.skipped')
+            return downloaded  # file was already downloaded?
+
+        def add_to_index(result):
+            if os.path.exists(abs_out_path):
+                file_index.add(os.path.basename(abs_out_path), os.path.getsize(abs_out_path))
+            return result
+
+        if self.blob_store is not None:
+            blob = self.blob_store.find(url)
+            if blob is not None:
+                # this file has already been downloaded for another dialog
+                metrics.count('downloads.dedup_hits')
+                if not has_ext and auto_image_ext:
+                    abs_out_path += os.path.splitext(blob)[1]
+                return add_to_index(self.blob_store.link(blob, abs_out_path))
 
         def update_progress():
             display_filename = out_filename
@@ -115,60 +256,180 @@ class DialogExporter:
                 display_filename += ', ' + fmt_size(size)
             progress.step_msg('%s -> %s' % (url, display_filename))
 
+        # partially downloaded file is kept under a name that does not depend on the extension we get later,
+        # so the download can be resumed by a next attempt or a next run
+        part_path = abs_out_path + PART_SUFFIX
+        # the API gives sizes of documents only, sizes of other files are taken from the first response
+        expected_size = size
+
         def try_download(src_url):
             nonlocal out_filename
             nonlocal rel_out_path
             nonlocal abs_out_path
             nonlocal has_ext
-
-            try:
-                request = urllib.request.urlopen(src_url, timeout=20)
-                if not has_ext and auto_image_ext and 'Content-Type' in request.info():
-                    ext = '.' + guess_image_ext(request.info()['Content-Type'])
-                    out_filename = out_filename + ext
-                    rel_out_path = rel_out_path + ext
-                    abs_out_path = abs_out_path + ext
-                    has_ext = True
-                    update_progress()
-                with open(abs_out_path, 'wb') as f:
-                    f.write(request.read())
-                    return True
-            except Exception:
-                return None
+            nonlocal expected_size
+
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            # a previous attempt or run could have stopped right before renaming the complete file
+            if not (expected_size > 0 and offset == expected_size):
+                headers = {'Range': 'bytes=%s-' % offset} if offset > 0 else None
+                try:
+                    request = http_pool.urlopen(src_url, timeout=20, headers=headers)
+                except urllib.error.HTTPError as error:
+                    if error.code != 416:
+                        raise
+                    # the range starts at the end of the file when the partial file is already complete
+                    if (has_ext or not auto_image_ext) and get_response_size(error.headers, -1) == offset:
+                        os.replace(part_path, abs_out_path)
+                        return
+                    # partial file does not match the file on the server anymore
+                    os.remove(part_path)
+                    raise IncompleteDownloadError('Failed to resume download, starting from scratch')
+
+                with request:
+                    if offset > 0 and not request.getheader('Content-Range', '').startswith('bytes %s-' % offset):
+                        offset = 0  # server ignores Range header and sends the whole file
+                    elif offset > 0:
+                        metrics.count('downloads.resumed')
+                    if expected_size <= 0:
+                        expected_size = get_response_size(request.info(), offset)
+
+                    if not has_ext and auto_image_ext and 'Content-Type' in request.info():
+                        ext = '.' + guess_image_ext(request.info()['Content-Type'])
+                        out_filename = out_filename + ext
+                        rel_out_path = rel_out_path + ext
+                        abs_out_path = abs_out_path + ext
+                        has_ext = True
+                        update_progress()
+
+                    with open(part_path, 'ab' if offset > 0 else 'wb') as f:
+                        for chunk in iter(lambda: request.read(DOWNLOAD_CHUNK_SIZE), b''):
+                            f.write(chunk)
+                            offset += len(chunk)
+                            metrics.count('downloads.bytes', len(chunk))
+                            progress.add_bytes(len(chunk))
+
+            if expected_size > 0 and offset != expected_size:
+                if offset > expected_size:
+                    os.remove(part_path)
+                raise IncompleteDownloadError('Downloaded %s bytes, expected %s' % (offset, expected_size))
+            # file is renamed only when it is complete, so an interrupted download never leaves a truncated file
+            # that looks like a downloaded one
+            os.replace(part_path, abs_out_path)
+
+        def report_retry(error, delay):
+            metrics.count('downloads.retries')
 
         update_progress()
         try:
-            try_count = 0
-            while try_count < 3:
-                # sys.stdout.write("Downloading photo %s\n" % (message["id"]))
-                if try_download(url):
-                    return rel_out_path
-                try_count += 1
+            with metrics.timer('stage.download'):
+                download_retry_policy.run(lambda: try_download(url), report_retry,
+                                          breaker=download_breakers.get(urllib.parse.urlsplit(url).hostname))
+            metrics.count('downloads.files')
+            if self.blob_store is not None:
+                return add_to_index(self.blob_store.add(url, abs_out_path))
+            return add_to_index(rel_out_path)
+        except Exception as error:
+            metrics.count('downloads.failed')
+            progress.error("Failed to retrieve file (%s): %s, skipping\n" % (url, str(error)))
+            return None
         finally:
             progress.clear_step_msg()
 
-        progress.error("Failed to retrieve file (%s) after 3 attempts, skipping\n" % url)
-        return None
-
     def download_image(self, attachment, key_override="photo_"):
         filename = str(attachment['id'])
         url = attachment[self.find_largest(attachment, key_override)]
         return self.download_file(url, filename, True)
 
-    def fetch_messages(self):
+    def download_avatar(self, profile):
+        # avatars are named after their urls, so a changed profile photo is downloaded again
+        url = profile[self.find_largest(profile)]
+        return self.download_file(url, hashlib.sha1(url.encode('utf-8')).hexdigest(), True, attach_dir=AVATARS_DIR)
+
+    def fetch_history_batch(self, params, offset, calls):
+        # several messages.getHistory calls are packed into a single execute request
+        code = 'return [%s];' % ', '.join(
+            'API.messages.getHistory(%s)' % json.dumps(dict(params + [('offset', offset + HISTORY_PAGE_SIZE * j),
+                                                                      ('count', HISTORY_PAGE_SIZE)]))
+            for j in range(calls)
+        )
+
+        pages = self.api.call('execute', [('code', code)])
+        if not isinstance(pages, list) or len(pages) != calls or not all(isinstance(page, dict) for page in pages):
+            raise RuntimeError('Unexpected reply from execute method')
+        return pages
+
+    def fetch_pages(self):
         offset = 0
 
         selector = 'user_id' if self.type == 'user' else 'peer_id'
         author_id = self.id if self.type == 'user' else (2000000000 + self.id if self.type == 'chat' else -self.id)
+        params = [(selector, author_id), ('rev', 1)]
+        if self.start_message_id > 0:
+            params.append(('start_message_id', self.start_message_id))
 
+        batch = min(self.options.arguments.execute_batch, EXECUTE_MAX_CALLS)
         while True:
-            messages = self.api.call('messages.getHistory',
-                                     [('offset', offset), ('count', 200), (selector, author_id), ('rev', 1)])
-            if len(messages['items']) == 0:
-                break
-            for msg in messages['items']:
-                yield (msg, messages['count'])
-            offset += len(messages['items'])
+            with metrics.timer('stage.fetch_history'):
+                if batch > 1:
+                    try:
+                        pages = self.fetch_history_batch(params, offset, batch)
+                    except RuntimeError as error:
+                        progress.error("Failed to fetch history with execute method (%s), falling back to regular "
+                                       "paging\n" % str(error))
+                        batch = 0
+                        continue
+                else:
+                    pages = [self.api.call('messages.getHistory',
+                                           [('offset', offset), ('count', HISTORY_PAGE_SIZE)] + params)]
+
+            for messages in pages:
+                if len(messages['items']) == 0:
+                    return
+                # history starts with the last message we have already exported
+                items = [msg for msg in messages['items'] if msg.get('id', 0) > self.start_message_id]
+                if len(items) > 0:
+                    yield (items, max(messages['count'] - self.exported_count, 0))
+                offset += len(messages['items'])
+
+    def fetch_messages(self):
+        for items, total in self.fetch_pages():
+            for msg in items:
+                yield (msg, total)
+
+    def fetch_chat_members(self):
+        try:
+            chat = self.api.call('messages.getChat', [('chat_id', self.id), ('fields', 'photo_50')])
+        except RuntimeError as error:
+            progress.error("Failed to get members of chat %s (%s), skipping\n" % (self.id, str(error)))
+            return []
+        return [user for user in chat.get('users', []) if isinstance(user, dict) and 'first_name' in user]
+
+    def collect_user_ids(self, vk_msg, user_ids):
+        # ids of users and groups export_message is going to need
+        user_ids.add(vk_msg.get('from_id', 0) or vk_msg.get('user_id', 0))
+
+        for fwd_msg in vk_msg.get('fwd_messages', []):
+            self.collect_user_ids(fwd_msg, user_ids)
+
+        if vk_msg.get('action_mid', 0) > 0 and vk_msg.get('action') in USER_ACTIONS:
+            user_ids.add(vk_msg['action_mid'])
+
+        def collect_from_attachments(attachments):
+            for att in attachments:
+                if att['type'] == 'video':
+                    user_ids.add(att['video'].get('owner_id', 0))
+                elif att['type'] == 'wall':
+                    collect_from_post(att['wall'])
+
+        def collect_from_post(wall):
+            user_ids.add(wall.get('from_id', 0))
+            user_ids.add(wall.get('to_id', 0))
+            collect_from_attachments(wall.get('attachments', []))
+            for repost in wall.get('copy_history', []):
+                collect_from_post(repost)
+
+        collect_from_attachments(vk_msg.get('attachments', []))
 
     def handle_link(self, context, link):
         downloaded = None
@@ -209,7 +470,12 @@ class DialogExporter:
 
         url = largest['url'] if largest is not None else ''
 
-        downloaded = self.download_file(url, str(sticker.get('sticker_id', 0)), True) if largest is not None else None
+        downloaded = None
+        if largest is not None and sticker.get('sticker_id'):
+            downloaded = self.download_file(url, '%s_%s' % (sticker['sticker_id'], largest['width']), True,
+                                            attach_dir=STICKERS_DIR)
+        elif largest is not None:
+            downloaded = self.download_file(url, '0', True)
 
         return {
             'type': 'sticker',
@@ -367,6 +633,7 @@ class DialogExporter:
     def export_message(self, ctx, vk_msg):
         # write message head
         exported_msg = {
+            'id': vk_msg.get('id', 0),
             'date': vk_msg.get('date', 0),
             'message': vk_msg.get('body', ''),
             'is_important': vk_msg.get('important', False),
@@ -415,22 +682,64 @@ class DialogExporter:
 
         return exported_msg
 
-    def export(self):
+    def export(self, writer):
+        # messages are passed to the writer as soon as they are ready, returns the map of mentioned users
         cur_step = 0
 
         ctx = ExportContext(self.user_fetcher)
 
-        for msg, total in self.fetch_messages():
-            if cur_step == 0:
-                progress.update(0, total)
-
-            exported_msg = self.export_message(ctx, msg)
-
-            self.json_out['messages'].append(exported_msg)
-
-            cur_step += 1
-            progress.update(cur_step, total)
-
-        self.json_out['users'] = ctx.users
+        self.download_pool = DownloadPool(self.options.arguments.download_workers)
+        try:
+            # exported messages waiting for their attachments to be downloaded
+            pending = collections.deque()
+
+            def flush(keep):
+                nonlocal cur_step
+                while len(pending) > keep:
+                    exported_msg, total = pending.popleft()
+                    with metrics.timer('stage.wait_downloads'):
+                        self.user_fetcher.resolve_pending()
+                        resolve_downloads(exported_msg)
+                    with metrics.timer('stage.write'):
+                        writer.write_message(exported_msg, ctx.users)
+
+                    cur_step += 1
+                    self.message_count += 1
+                    metrics.count('messages')
+                    progress.update(cur_step, total)
+
+            if self.type == 'chat':
+                with metrics.timer('stage.resolve_users'):
+                    members = self.fetch_chat_members()
+                    for user in members:
+                        if user['id'] not in self.user_fetcher.cache:
+                            self.user_fetcher.add_user(user, self)
+                    if self.user_fetcher.profile_cache is not None and members:
+                        self.user_fetcher.profile_cache.put_many(dict((user['id'], user) for user in members))
+
+            for items, total in self.fetch_pages():
+                if cur_step == 0 and len(pending) == 0:
+                    progress.update(0, total)
+
+                user_ids = set()
+                for msg in items:
+                    self.collect_user_ids(msg, user_ids)
+                with metrics.timer('stage.resolve_users'):
+                    ctx.prefetch_users(user_ids, self)
+
+                for msg in items:
+                    with metrics.timer('stage.export_message'):
+                        exported_msg = self.export_message(ctx, msg)
+                    pending.append((exported_msg, total))
+                    metrics.set_gauge('queue.pending_messages', len(pending))
+                    flush(self.download_pool.backlog)
+                    self.last_message_id = max(self.last_message_id, msg.get('id', 0))
+
+            flush(0)
+
+            self.user_fetcher.resolve_pending()
+        finally:
+            self.download_pool.shutdown()
+            self.download_pool = None
 
-        return self.json_out
+        return ctx.users
@@ -0,0 +1,71 @@
+import os
+import threading
+
+
+# suffix of partially downloaded files, they are not indexed
+PART_SUFFIX = '.part'
+
+
+# the directory is listed once and updated as files are downloaded. Images get their extension from Content-Type, so
+# files are indexed by names without extensions too
+class FileIndex:
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.sizes = dict()
+        self.names_by_stem = dict()
+
+        os.makedirs(directory, exist_ok=True)
+        if not os.path.isdir(directory):
+            raise OSError("Unable to create attachments directory %s" % directory)
+
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith(PART_SUFFIX):
+                    self._add(entry.name, entry.stat().st_size)
+
+    def _add(self, name, size):
+        self.sizes[name] = size
+        stem = os.path.splitext(name)[0]
+        if self.sizes.get(self.names_by_stem.get(stem), 0) == 0:
+            self.names_by_stem[stem] = name
+
+    def add(self, name, size):
+        with self.lock:
+            self._add(name, size)
+
+    def refresh(self, names):
+        # stickers and avatars directories are shared, other worker processes download files into them too
+        for name in names:
+            try:
+                size = os.path.getsize(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            self.add(name, size)
+
+    def has_file(self, name):
+        with self.lock:
+            return self.sizes.get(name, 0) > 0
+
+    def find_by_stem(self, stem):
+        with self.lock:
+            name = self.names_by_stem.get(stem)
+            if name is not None and self.sizes.get(name, 0) > 0:
+                return name
+            return None
+
+
+class FileIndexes:
+    def __init__(self):
+        self.indexes = dict()
+        self.lock = threading.Lock()
+
+    def get(self, directory):
+        with self.lock:
+            if directory not in self.indexes:
+                self.indexes[directory] = FileIndex(directory)
+            return self.indexes[directory]
+
+
+# directories of stickers and avatars are shared between dialogs, so indexes are shared too
+file_indexes = FileIndexes()
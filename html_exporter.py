@@ -1,87 +1,493 @@
+from search_index import *
+from template import *
 from utils import *
 import codecs
+import datetime
 import json
+import os
 
 
 MSG_MERGE_TIMEOUT = 60 * 5 # two sequential messages from the same sender are going to be merged into one if sent in this time range
+OUTPUT_BUFFER_SIZE = 256 * 1024
+# room left in the navigation at the top of a page for the key of the next page, which is not known yet
+PAGE_KEY_MAX_LENGTH = 16
+
+
+HEAD_TEMPLATE = Template('''
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="utf-8" />
+            {link_block}
+            {script_block}
+        </head>
+        <body>
+            {search_block}
+            <div class="messages">
+        ''')
+
+PAGES_NAV_TEMPLATE = Template('''
+        <div class="pages-nav">
+            {prev_block}
+            <a class="pages-nav__index" href="{index}">All pages</a>
+            {next_block}
+        </div>
+        ''')
+
+PAGES_INDEX_ITEM_TEMPLATE = Template('''
+        <div class="pages-index__page">
+            <a class="pages-index__link" href="{filename}">{first_date} &mdash; {last_date}</a> <span class="pages-index__count">({count} messages)</span>
+        </div>
+        ''')
+
+ACTION_MESSAGE_TEMPLATE = Template('''
+        <div class="msg msg--level-{level} msg--action msg-action"{anchor} data-json='{json}'>
+            <span class="msg-action__sender">{sender_fullname}</span>
+            :
+            {message}
+            {attach_block}
+        </div>
+        ''')
+
+MESSAGE_TEMPLATE = Template('''
+        <div class="msg msg--level-{level} {extra_classes}"{anchor} data-json='{json}'>
+            <div class="msg-head {extra_head_classes}">
+                <div class="msg-head__photo-block">
+                    <img class="msg-head__photo" src="{sender_photo}" />
+                </div>
+                <div class="msg-head__info">
+                    <a class="msg-head__profile" href="{sender_profile}" title="{sender_fullname}">{sender_firstname}</a>
+                    <div class="msg-head__date-block">
+                        <span class="msg-head__date">{date}</span>
+                    </div>
+                </div>
+            </div>
+            <div class="msg-body">
+                <div class="msg-text">
+                    {message}
+                    {edited_block}
+                </div>
+                {fwd_block}
+                {attach_block}
+            </div>
+        </div>
+        ''')
+
+EDITED_TEMPLATE = Template('<span class="msg-edited">(Edited {diff} after)</span>')
+FORWARDED_TEMPLATE = Template('<div class="msg-forwarded">{fwd_block}</div>')
+SEARCH_TEMPLATE = Template('''
+        <div class="search">
+            <input class="search__input" type="search" placeholder="Search messages" />
+            <div class="search__results"></div>
+        </div>
+        ''')
+ATTACHMENTS_TEMPLATE = Template('<div class="msg-attachments">{attach_block}</div>')
+VIDEO_UPLOADER_TEMPLATE = Template('<a href="{link}">{name}</a>')
+AUDIO_PLAYER_TEMPLATE = Template('<audio class="attach-audio__audio" controls src="{filename}" />')
+
+UNKNOWN_TEMPLATE = Template('''
+        <div class="attach attach-{type}">
+            <span class="attach-{type}__title">{title}</span>
+        </div>
+        ''')
+
+LINK_TEMPLATE = Template('''
+        <div class="attach attach-link">
+            <a class="attach-link__link-block" title="{title}" href="{url}">
+                <div class="attach-link__image-block">
+                    <img class="attach-link__image" src="{filename}" />
+                </div>
+                <div class="attach-link__description">
+                    <div class="attach-link__title">{title}</div>
+                    <div class="attach-link__description-text">{description}</div>
+                    <div class="attach-link__caption">{caption}</div>
+                </div>
+            </a>
+        </div>
+        ''')
+
+LINK_NO_IMAGE_TEMPLATE = Template('''
+        <div class="attach attach-link">
+            <a class="attach-link__link-block attach-link__link-block--no-image" title="{title}" href="{url}">
+                <div class="attach-link__description">
+                    <div class="attach-link__title">{title}</div>
+                    <div class="attach-link__description-text">{description}</div>
+                    <div class="attach-link__caption">{caption}</div>
+                </div>
+            </a>
+        </div>
+        ''')
+
+PHOTO_TEMPLATE = Template('''
+        <div class="attach attach-photo">
+            <span class="attach-photo__title">{description}</span>
+            <img class="attach-photo__image" src="{filename}" alt="{description}" />
+        </div>
+        ''')
+
+STICKER_TEMPLATE = Template('''
+        <div class="attach attach-sticker">
+            <img class="attach-sticker__image" src="{filename}" />
+        </div>
+        ''')
+
+VIDEO_TEMPLATE = Template('''
+        <div class="attach attach-video">
+            <a class="attach-video__link" href="{url}" title="{title}">
+                <img class="attach-video__thumbnail" src="{thumbnail_filename}" alt="{title}" />
+                <div class="attach-video__title">{title}</div>
+            </a>
+            <div class="attach-video__meta meta">
+                <p>Views on VK: <span class="meta__views">{views}, comments on VK: <span class="meta__comments">{comments}</span></p>
+                <p>Added at: <span class="meta__date">{date}</span> from {platform} by {uploader_profile}</p>
+            </div>
+            <div class="attach-video__description">{description}</div>
+        </div>
+        ''')
+
+POST_HEAD_TEMPLATE = Template('''
+        <div class="post-head">
+            <div class="post-head__image-block">
+                <img class="post-head__image" src="{filename}" />
+            </div>
+            <div class="post-head__info">
+                <div class="post-head__name">
+                    <a class="post-head__link" href="{link}">{name}</a>
+                </div>
+                <div class="post-head__date">{date}</div>
+            </div>
+        </div>
+        ''')
+
+POST_HEAD_NO_IMAGE_TEMPLATE = Template('''
+        <div class="post-head">
+            <div class="post-head__name">
+                <a class="post-head__link" href="{link}">{name}</a>
+            </div>
+            <div class="post-head__date">{date}</div>
+        </div>
+        ''')
+
+REPOST_TEMPLATE = Template('''
+        <div class="attach-post__repost">
+            {repost_block}
+        </div>
+        ''')
+
+POST_TEMPLATE = Template('''
+        <div class="attach attach-post">
+            {head_block}
+            <div class="attach-post__text">{text}</div>
+            <a class="attach-post__link" href="{url}"></a>
+            {attach_block}
+            {repost_block}
+        </div>
+        ''')
+
+AUDIO_TEMPLATE = Template('''
+        <div class="attach attach-audio">
+            <div class="attach-audio__title">
+                Audio:
+                <span class="attach-audio__author">
+                    <span class="attach-audio__composition-artist">{artist}</span>
+                    -
+                    <span class="attach-audio__composition-title">{title}</span>
+                </span>
+            </div>
+            <span class="attach-audio__audio-block">
+                {audio_block}
+                <div class="attach-audio__duration">{duration}</div>
+            </span>
+        </div>
+        ''')
+
+VOICE_TEMPLATE = Template('''
+        <div class="attach attach-voice">
+            <div class="attach-voice__title">Voice message</div>
+            <div class="attach-voice__audio-block">
+                <audio class="attach-voice__audio" controls src="{filename}"></audio>
+                <div class="attach-voice__duration">{duration}</div>
+            </div>
+        </div>
+        ''')
+
+DOC_TEMPLATE = Template('''
+        <div class="attach attach-doc">
+            <a href="{filename}" class="attach-doc__link-block">
+                <div class="attach-doc__desc">
+                    <div class="attach-doc__link" title="{title}">{title}</div>
+                    <div class="attach-doc__size">{size}</div>
+                </div>
+            </a>
+        </div>
+        ''')
+
+GIFT_TEMPLATE = Template('''
+        <div class="attach attach-gift">
+            <div class="attach-gift__title">Gift</div>
+            <img class="attach-gift__thumbnail" src="{thumbnail}" />
+        </div>
+        ''')
 
 
 class HTMLExporterOutput:
-    def __init__(self):
-        self.data = []
+    def __init__(self, file):
+        self.file = file
 
     def append(self, text):
-        self.data.append(text)
-
-    def get(self):
-        return ''.join(self.data)
+        self.file.write(text)
 
 
 class HTMLExporterContext:
-    def __init__(self, progress, output, input_json, level):
+    def __init__(self, progress, output, users, level):
         self.progress = progress
         self.output = output
-        self.input_json = input_json
+        self.users = users
         self.level = level
         self.prev_merge_sender = None
         self.prev_merge_msg_timestamp = 0
 
     def next_level(self):
-        return HTMLExporterContext(self.progress, self.output, self.input_json, self.level + 1)
+        return HTMLExporterContext(self.progress, self.output, self.users, self.level + 1)
 
 
 class HTMLExporter:
     def __init__(self, options):
         self.options = options
+        self.split = options.html_split
+        self.stylesheet = None
+        self.dialog_id = None
+        self.progress = None
+        self.state = None
+        self.file = None
+        self.ctx = None
+        self.pages = []
+        self.search_script = None
+        self.search_index = None
 
     @property
     def extension(self):
         return "html"
 
-    def export(self, input_json, progress):
-        # load stylesheet early
-        with codecs.open('style.css', 'r', encoding='utf-8') as f:
-            stylesheet = f.read()
+    @property
+    def is_paginated(self):
+        return self.split is not None
+
+    def get_filename(self, dialog_id):
+        return os.path.join(self.options.output_dir, '%s.%s' % (dialog_id, self.extension))
 
-        ctx = HTMLExporterContext(progress, HTMLExporterOutput(), input_json, 1)
+    def can_resume(self, state):
+        return 'body_end' in state.output and state.output.get('split') == self.split
 
+    @property
+    def has_search(self):
+        return not self.options.arguments.no_search_index
+
+    def get_head(self, stylesheet):
         if self.options.arguments.embed_resources:
             link_block = '<style>{stylesheet}</style>'.format(stylesheet=stylesheet)
         else:
             link_block = '<link rel="stylesheet" href="style.css" />'
 
-        ctx.output.append('''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="utf-8" />
-            {link_block}
-        </head>
-        <body>
-            <div class="messages">
-        '''.format(link_block=link_block))
+        script_block = ''
+        search_block = ''
+        if self.has_search:
+            if not self.embeds_index:
+                # the index can be large, deferred scripts do not block rendering of the page
+                script_block = '<script defer src="{index}"></script>'.format(
+                    index=os.path.basename(SearchIndex.get_filename(self.options.output_dir, self.dialog_id)))
+            if self.options.arguments.embed_resources:
+                script_block += '<script>{script}</script>'.format(script=self.search_script)
+            else:
+                script_block += '<script defer src="search.js"></script>'
+            search_block = SEARCH_TEMPLATE.render()
+
+        return HEAD_TEMPLATE.render(link_block=link_block, script_block=script_block, search_block=search_block)
+
+    @property
+    def embeds_index(self):
+        # pages of split output would each need a copy of the index of the whole dialog, they share the index file
+        return self.has_search and self.options.arguments.embed_resources and not self.is_paginated
+
+    def get_index_block(self, index_script):
+        # the index is complete only after all messages are written, so it is put at the end of the file
+        if index_script is None or not self.embeds_index:
+            return ''
+        # words of the index never contain "<", but a closing tag inside the script would end it
+        return '<script>{index}</script>'.format(index=index_script.replace('</', '<\\/'))
+
+    def get_pages_nav(self, prev_page, next_page):
+        prev_block = '<a class="pages-nav__prev" href="{filename}">&larr; Previous page</a>'.format(**prev_page) \
+            if prev_page is not None else ''
+        next_block = '<a class="pages-nav__next" href="{filename}">Next page &rarr;</a>'.format(**next_page) \
+            if next_page is not None else ''
+
+        return PAGES_NAV_TEMPLATE.render(prev_block=prev_block, next_block=next_block,
+                                         index=os.path.basename(self.get_filename(self.dialog_id)))
+
+    def begin(self, dialog_id, progress, state, resume):
+        # when resuming, messages are appended after the last message written by the previous export, the first page of
+        # split output is opened when the first message arrives
+        # load stylesheet early
+        with codecs.open('style.css', 'r', encoding='utf-8') as f:
+            self.stylesheet = f.read()
+        if self.has_search:
+            with codecs.open('search.js', 'r', encoding='utf-8') as f:
+                self.search_script = f.read()
+
+            # the index is kept in memory while the dialog is exported and saved with the rest of the output
+            self.search_index = SearchIndex()
+            if resume:
+                self.search_index = SearchIndex.load(SearchIndex.get_filename(self.options.output_dir, dialog_id))
+                self.search_index.truncate(state.output.get('search_count', 0))
+
+        self.dialog_id = dialog_id
+        self.progress = progress
+        self.state = state
+        self.pages = state.output.get('pages', []) if resume else []
+
+        if resume:
+            filename = self.get_filename(dialog_id)
+            if self.is_paginated:
+                filename = os.path.join(self.options.output_dir, self.pages[-1]['filename'])
+            self.open_file(filename, resume)
+            self.file.seek(state.output['body_end'])
+            self.file.truncate()
+            self.ctx.prev_merge_sender = state.output.get('prev_merge_sender')
+            self.ctx.prev_merge_msg_timestamp = state.output.get('prev_merge_msg_timestamp', 0)
+        elif not self.is_paginated:
+            self.open_file(self.get_filename(dialog_id), resume)
+            self.ctx.output.append(self.get_head(self.stylesheet))
+
+    def open_file(self, filename, resume):
+        self.file = codecs.open(filename, 'r+' if resume else 'w', encoding='utf-8', buffering=OUTPUT_BUFFER_SIZE)
+        self.ctx = HTMLExporterContext(self.progress, HTMLExporterOutput(self.file), dict(), 1)
+
+    def close_file(self, next_page=None, index_block=''):
+        # returns the offset the next export should append messages at
+        body_end = self.file.tell()
+
+        if self.is_paginated:
+            self.ctx.output.append(self.get_pages_nav(self.pages[-2] if len(self.pages) > 1 else None, next_page))
+
+        self.ctx.output.append('</div>' + index_block + '</body></html>')
+        if next_page is not None and 'top_nav_start' in self.pages[-1]:
+            self.file.seek(self.pages[-1]['top_nav_start'])
+            self.file.write(self.get_top_pages_nav(next_page))
+        self.file.close()
+        self.file = None
+        return body_end
+
+    def get_top_pages_nav(self, next_page):
+        # the navigation at the top is written again when the next page is known, it is padded to the length
+        # it can have with the link to the next page, so it can be overwritten in place
+        prev_page = self.pages[-2] if len(self.pages) > 1 else None
+        longest_next_page = {'filename': '%s-%s.%s' % (self.dialog_id, '0' * PAGE_KEY_MAX_LENGTH, self.extension)}
+        return self.get_pages_nav(prev_page, next_page).ljust(len(self.get_pages_nav(prev_page, longest_next_page)))
+
+    def get_page_key(self, msg):
+        if self.split == 'month':
+            key = datetime.datetime.fromtimestamp(msg['date']).strftime('%Y-%m')
+            # do not reopen a page that has already been written if dates of messages are out of order
+            return max(key, self.pages[-1]['key']) if len(self.pages) > 0 else key
+
+        if len(self.pages) == 0 or self.pages[-1]['count'] >= self.split:
+            return str(len(self.pages) + 1)
+        return self.pages[-1]['key']
+
+    def start_page(self, key):
+        page = {
+            'key': key,
+            'filename': '%s-%s.%s' % (self.dialog_id, key, self.extension),
+            'first_date': 0,
+            'last_date': 0,
+            'count': 0
+        }
 
-        cur_step = 0
-        total = len(input_json['messages'])
-        for msg in input_json['messages']:
-            if cur_step == 0:
-                ctx.progress.update(0, total)
+        if self.file is not None:
+            self.close_file(page)
+        self.pages.append(page)
+
+        # merge state is reset, so the first message on a page always has its header
+        self.open_file(os.path.join(self.options.output_dir, page['filename']), False)
+        self.ctx.output.append(self.get_head(self.stylesheet))
+        page['top_nav_start'] = self.file.tell()
+        self.ctx.output.append(self.get_top_pages_nav(None))
+
+    def write_message(self, msg, users):
+        if self.is_paginated:
+            key = self.get_page_key(msg)
+            if self.file is None or key != self.pages[-1]['key']:
+                self.start_page(key)
+
+            page = self.pages[-1]
+            page['first_date'] = page['first_date'] or msg['date']
+            page['last_date'] = msg['date']
+            page['count'] += 1
+
+        self.ctx.users = users
+        self.ctx.output.append(self.export_message(self.ctx, msg))
+
+        if self.search_index is not None:
+            page = self.pages[-1]['filename'] if self.is_paginated else os.path.basename(self.get_filename(self.dialog_id))
+            self.search_index.add(page, msg['id'], msg['date'], self.get_search_texts(msg))
+
+    def get_search_texts(self, msg):
+        # text of a message, its forwarded messages and attachments
+        yield msg.get('message', '')
+        for fwd_msg in msg.get('forwarded', []):
+            yield from self.get_search_texts(fwd_msg)
+
+        attachments = list(msg.get('attachments', []))
+        while attachments:
+            attach = attachments.pop()
+            for key in ('title', 'description', 'text'):
+                if isinstance(attach.get(key), str):
+                    yield attach[key]
+            attachments.extend(attach.get('attachments', []))
+            attachments.extend(attach.get('repost', []))
+
+    def end(self, users):
+        self.state.output = {
+            'split': self.split
+        }
 
-            ctx.output.append(self.export_message(ctx, msg))
+        index_script = self.search_index.get_script() if self.search_index is not None else None
+        index_block = self.get_index_block(index_script)
 
-            cur_step += 1
-            ctx.progress.update(cur_step, total)
+        if self.file is not None:
+            self.state.output.update({
+                'body_end': self.close_file(index_block=index_block),
+                'prev_merge_sender': self.ctx.prev_merge_sender,
+                'prev_merge_msg_timestamp': self.ctx.prev_merge_msg_timestamp
+            })
+        self.ctx = None
 
-        ctx.output.append('</div></body></html>')
+        if self.is_paginated:
+            self.state.output['pages'] = self.pages
+            self.write_index()
 
-        files = dict()
-        if not self.options.arguments.embed_resources:
-            files['style.css'] = stylesheet
+        if self.search_index is not None:
+            # the index file is saved when the index is embedded too, the next incremental export adds messages to it
+            self.search_index.save(SearchIndex.get_filename(self.options.output_dir, self.dialog_id), index_script)
+            self.state.output['search_count'] = self.search_index.message_count
+            self.search_index = None
 
-        return {
-            'text': ctx.output.get(),
-            'files': files
-        }
+        if not self.options.arguments.embed_resources:
+            with codecs.open(os.path.join(self.options.output_dir, 'style.css'), 'w', encoding='utf-8') as f:
+                f.write(self.stylesheet)
+            if self.has_search:
+                with codecs.open(os.path.join(self.options.output_dir, 'search.js'), 'w', encoding='utf-8') as f:
+                    f.write(self.search_script)
+
+    def write_index(self):
+        with codecs.open(self.get_filename(self.dialog_id), 'w', encoding='utf-8') as f:
+            f.write(self.get_head(self.stylesheet))
+            f.write('<div class="pages-index">')
+            for page in self.pages:
+                f.write(PAGES_INDEX_ITEM_TEMPLATE.render(page, first_date=fmt_timestamp(page['first_date']),
+                                                         last_date=fmt_timestamp(page['last_date'])))
+            f.write('</div></div></body></html>')
 
     def get_action_text(self, ctx, msg, action, action_text, action_mid):
         action_text_dict = {
@@ -105,43 +511,31 @@ class HTMLExporter:
             elif action_mid == msg['sender']['id']:
                 return 'Left the chat'
             else:
-                user_data = ctx.input_json['users'].get(action_mid)
+                user_data = ctx.users.get(action_mid)
                 user_name = user_data['name'] if user_data is not None else '?'
                 return 'Kicked user <span class="new-chat-title">{name}</span>'.format(name=user_name)
         else:
             return action_text_dict.get(action, '')
 
+    def get_anchor(self, ctx, msg):
+        # search results link to messages by their ids, forwarded messages are found through messages they are in
+        return ' id="m{id}"'.format(id=msg['id']) if ctx.level == 1 else ''
+
     def export_action_message(self, ctx, msg):
         ctx.prev_merge_sender = None
 
-        sender = ctx.input_json['users'][msg['sender']['id']]
+        sender = ctx.users[msg['sender']['id']]
 
-        attach_block = ''
-        if 'attachments' in msg:
-            for attachment in msg['attachments']:
-                attach_block += self.export_attachment(ctx, attachment)
+        attach_block = self.export_attachments(ctx, msg.get('attachments', []))
 
-        if len(attach_block) > 0:
-            attach_block = '<div class="msg-attachments">{attach_block}</div>'.format(attach_block=attach_block)
-
-        return '''
-        <div class="msg msg--level-{level} msg--action msg-action" data-json='{json}'>
-            <span class="msg-action__sender">{sender_fullname}</span>
-            :
-            {message}
-            {attach_block}
-        </div>
-        '''.format(**{
-            'level': ctx.level,
-            'json': json.dumps(msg, ensure_ascii=False) if self.options.arguments.save_json_in_html else '',
-            'sender_profile': sender['link'],
-            'sender_fullname': sender['name'],
-            'sender_firstname': sender['first_name'],
-            'sender_photo': sender['filename'],
-            'date': fmt_timestamp(msg['date']),
-            'message': self.get_action_text(ctx, msg, msg['action'], msg.get('action_text', ''), msg.get('action_mid', None)),
-            'attach_block': attach_block
-        })
+        return ACTION_MESSAGE_TEMPLATE.render(
+            level=ctx.level,
+            anchor=self.get_anchor(ctx, msg),
+            json=json.dumps(msg, ensure_ascii=False) if self.options.arguments.save_json_in_html else '',
+            sender_fullname=sender['name'],
+            message=self.get_action_text(ctx, msg, msg['action'], msg.get('action_text', ''), msg.get('action_mid', None)),
+            attach_block=attach_block
+        )
 
     def export_message(self, ctx, msg):
         if 'action' in msg:
@@ -156,24 +550,17 @@ class HTMLExporter:
             extra_classes.append('msg--edited')
 
         sender_id = msg['sender']['id']
-        sender = ctx.input_json['users'][sender_id]
+        sender = ctx.users[sender_id]
 
         fwd_block = ''
         if 'forwarded' in msg:
             nested_context = ctx.next_level()
-            for fwd_msg in msg['forwarded']:
-                fwd_block += self.export_message(nested_context, fwd_msg)
+            fwd_block = ''.join([self.export_message(nested_context, fwd_msg) for fwd_msg in msg['forwarded']])
 
         if len(fwd_block) > 0:
-            fwd_block = '<div class="msg-forwarded">{fwd_block}</div>'.format(fwd_block=fwd_block)
+            fwd_block = FORWARDED_TEMPLATE.render(fwd_block=fwd_block)
 
-        attach_block = ''
-        if 'attachments' in msg:
-            for attachment in msg['attachments']:
-                attach_block += self.export_attachment(ctx, attachment)
-
-        if len(attach_block) > 0:
-            attach_block = '<div class="msg-attachments">{attach_block}</div>'.format(attach_block=attach_block)
+        attach_block = self.export_attachments(ctx, msg.get('attachments', []))
 
         extra_head_classes = []
 
@@ -191,45 +578,30 @@ class HTMLExporter:
             ctx.prev_merge_sender = sender_id
             ctx.prev_merge_msg_timestamp = msg_date
 
-        return '''
-        <div class="msg msg--level-{level} {extra_classes}" data-json='{json}'>
-            <div class="msg-head {extra_head_classes}">
-                <div class="msg-head__photo-block">
-                    <img class="msg-head__photo" src="{sender_photo}" />
-                </div>
-                <div class="msg-head__info">
-                    <a class="msg-head__profile" href="{sender_profile}" title="{sender_fullname}">{sender_firstname}</a>
-                    <div class="msg-head__date-block">
-                        <span class="msg-head__date">{date}</span>
-                    </div>
-                </div>
-            </div>
-            <div class="msg-body">
-                <div class="msg-text">
-                    {message}
-                    {edited_block}
-                </div>
-                {fwd_block}
-                {attach_block}
-            </div>
-        </div>
-        '''.format(**{
-            'level': ctx.level,
-            'extra_classes': ' '.join(extra_classes) if extra_classes is not None else '',
-            'extra_head_classes': ' '.join(extra_head_classes) if extra_head_classes is not None else '',
-            'sender_profile': sender['link'],
-            'sender_fullname': sender['name'],
-            'sender_firstname': sender['first_name'],
-            'sender_photo': sender['filename'],
-            'date': fmt_timestamp(msg['date']) if not is_merged else fmt_date_diff(merge_date_diff, add_sign=True),
-            'edited_block': '<span class="msg-edited">(Edited {diff} after)</span>'.format(
+        return MESSAGE_TEMPLATE.render(
+            level=ctx.level,
+            anchor=self.get_anchor(ctx, msg),
+            extra_classes=' '.join(extra_classes),
+            extra_head_classes=' '.join(extra_head_classes),
+            sender_profile=sender['link'],
+            sender_fullname=sender['name'],
+            sender_firstname=sender['first_name'],
+            sender_photo=sender['filename'],
+            date=fmt_timestamp(msg['date']) if not is_merged else fmt_date_diff(merge_date_diff, add_sign=True),
+            edited_block=EDITED_TEMPLATE.render(
                 diff=fmt_date_diff(msg['updated_at'] - msg_date)
             ) if msg['is_updated'] else '',
-            'message': msg['message'],
-            'fwd_block': fwd_block,
-            'attach_block': attach_block,
-            'json': json.dumps(msg, ensure_ascii=False) if self.options.arguments.save_json_in_html else ''
-        })
+            message=msg['message'],
+            fwd_block=fwd_block,
+            attach_block=attach_block,
+            json=json.dumps(msg, ensure_ascii=False) if self.options.arguments.save_json_in_html else ''
+        )
+
+    def export_attachments(self, ctx, attachments):
+        attach_block = ''.join([self.export_attachment(ctx, attachment) for attachment in attachments])
+        if len(attach_block) > 0:
+            attach_block = ATTACHMENTS_TEMPLATE.render(attach_block=attach_block)
+        return attach_block
 
     def export_attachment(self, ctx, attach):
         known_types = ('photo', 'video', 'audio', 'doc', 'post', 'sticker', 'link', 'gift', 'voice')
@@ -240,210 +612,63 @@ class HTMLExporter:
             return self.handle_unknown(ctx, attach)
 
     def handle_unknown(self, ctx, attach):
-        return '''
-        <div class="attach attach-{type}">
-            <span class="attach-{type}__title">{title}</span>
-        </div>
-        '''.format(**{
-            'type': attach['type'],
-            'title': "Unknown attachment type"
-        })
+        return UNKNOWN_TEMPLATE.render(type=attach['type'], title="Unknown attachment type")
 
     def handle_link(self, ctx, attach):
         if 'filename' in attach and attach['filename'] is not None:
-            return '''
-            <div class="attach attach-link">
-                <a class="attach-link__link-block" title="{title}" href="{url}">
-                    <div class="attach-link__image-block">
-                        <img class="attach-link__image" src="{filename}" />
-                    </div>
-                    <div class="attach-link__description">
-                        <div class="attach-link__title">{title}</div>
-                        <div class="attach-link__description-text">{description}</div>
-                        <div class="attach-link__caption">{caption}</div>
-                    </div>
-                </a>
-            </div>
-            '''.format(**attach)
+            return LINK_TEMPLATE.render(attach)
         else:
-            return '''
-            <div class="attach attach-link">
-                <a class="attach-link__link-block attach-link__link-block--no-image" title="{title}" href="{url}">
-                    <div class="attach-link__description">
-                        <div class="attach-link__title">{title}</div>
-                        <div class="attach-link__description-text">{description}</div>
-                        <div class="attach-link__caption">{caption}</div>
-                    </div>
-                </a>
-            </div>
-            '''.format(**attach)
+            return LINK_NO_IMAGE_TEMPLATE.render(attach)
 
     def handle_photo(self, ctx, attach):
-        return '''
-        <div class="attach attach-photo">
-            <span class="attach-photo__title">{description}</span>
-            <img class="attach-photo__image" src="{filename}" alt="{description}" />
-        </div>
-        '''.format(**attach)
+        return PHOTO_TEMPLATE.render(attach)
 
     def handle_sticker(self, ctx, attach):
-        return '''
-        <div class="attach attach-sticker">
-            <img class="attach-sticker__image" src="{filename}" />
-        </div>
-        '''.format(**attach)
+        return STICKER_TEMPLATE.render(attach)
 
     def handle_video(self, ctx, attach):
-        args = {**attach, **{
-            'duration': fmt_time(attach['duration']),
-            'date': fmt_timestamp(attach['date'])
-        }}
-
         uploader_profile = ''
         owner_id = attach['owner_id']
-        if owner_id in ctx.input_json['users']:
-            uploader_profile = '<a href="{link}">{name}</a>'.format(**ctx.input_json['users'][owner_id])
+        if owner_id in ctx.users:
+            uploader_profile = VIDEO_UPLOADER_TEMPLATE.render(ctx.users[owner_id])
 
-        args['uploader_profile'] = uploader_profile
-
-        return '''
-        <div class="attach attach-video">
-            <a class="attach-video__link" href="{url}" title="{title}">
-                <img class="attach-video__thumbnail" src="{thumbnail_filename}" alt="{title}" />
-                <div class="attach-video__title">{title}</div>
-            </a>
-            <div class="attach-video__meta meta">
-                <p>Views on VK: <span class="meta__views">{views}, comments on VK: <span class="meta__comments">{comments}</span></p>
-                <p>Added at: <span class="meta__date">{date}</span> from {platform} by {uploader_profile}</p>
-            </div>
-            <div class="attach-video__description">{description}</div>
-        </div>
-        '''.format(**args)
+        return VIDEO_TEMPLATE.render(attach, duration=fmt_time(attach['duration']), date=fmt_timestamp(attach['date']),
+                                     uploader_profile=uploader_profile)
 
     def handle_post(self, ctx, attach):
-        args = {**attach, **{
-            'date': fmt_timestamp(attach['date'])
-        }}
+        date = fmt_timestamp(attach['date'])
 
-        attach_block = ''
-        if 'attachments' in attach:
-            for attachment in attach['attachments']:
-                attach_block += self.export_attachment(ctx, attachment)
-
-        if len(attach_block) > 0:
-            attach_block = '<div class="msg-attachments">{attach_block}</div>'.format(attach_block=attach_block)
-
-        args['attach_block'] = attach_block
+        attach_block = self.export_attachments(ctx, attach.get('attachments', []))
 
         head_block = ''
-        if 'from_id' in attach and attach['from_id'] in ctx.input_json['users']:
-            user_data = ctx.input_json['users'][attach['from_id']]
+        if 'from_id' in attach and attach['from_id'] in ctx.users:
+            user_data = ctx.users[attach['from_id']]
             if 'filename' in user_data:
-                head_block = '''
-                <div class="post-head">
-                    <div class="post-head__image-block">
-                        <img class="post-head__image" src="{filename}" />
-                    </div>
-                    <div class="post-head__info">
-                        <div class="post-head__name">
-                            <a class="post-head__link" href="{link}">{name}</a>
-                        </div>
-                        <div class="post-head__date">{date}</div>
-                    </div>
-                </div>
-                '''.format(**user_data, date=args['date'])
+                head_block = POST_HEAD_TEMPLATE.render(user_data, date=date)
             else:
-                head_block = '''
-                <div class="post-head">
-                    <div class="post-head__name">
-                        <a class="post-head__link" href="{link}">{name}</a>
-                    </div>
-                    <div class="post-head__date">{date}</div>
-                </div>
-                '''.format(**user_data, date=args['date'])
-
-        args['head_block'] = head_block
+                head_block = POST_HEAD_NO_IMAGE_TEMPLATE.render(user_data, date=date)
 
         repost_block = ''
         if 'repost' in attach:
             for repost in attach['repost']:
-                repost_block = '''
-                <div class="attach-post__repost">
-                    {repost_block}
-                </div>
-                '''.format(repost_block=self.handle_post(ctx, repost))
+                repost_block = REPOST_TEMPLATE.render(repost_block=self.handle_post(ctx, repost))
 
-        args['repost_block'] = repost_block
-
-        return '''
-        <div class="attach attach-post">
-            {head_block}
-            <div class="attach-post__text">{text}</div>
-            <a class="attach-post__link" href="{url}"></a>
-            {attach_block}
-            {repost_block}
-        </div>
-        '''.format(**args)
+        return POST_TEMPLATE.render(attach, head_block=head_block, attach_block=attach_block,
+                                    repost_block=repost_block)
 
     def handle_audio(self, ctx, attach):
-        args = {**attach, **{'duration': fmt_time(attach['duration'])}}
-
         if 'downloaded' in attach and attach['downloaded'] is not None:
-            audio_block = '<audio class="attach-audio__audio" controls src="{filename}" />'.format(**attach)
+            audio_block = AUDIO_PLAYER_TEMPLATE.render(attach)
         else:
             audio_block = '<div class="attach-audio__audio attach-audio__audio--failed">Unavailable</div>'
 
-        return '''
-        <div class="attach attach-audio">
-            <div class="attach-audio__title">
-                Audio:
-                <span class="attach-audio__author">
-                    <span class="attach-audio__composition-artist">{artist}</span>
-                    -
-                    <span class="attach-audio__composition-title">{title}</span>
-                </span>
-            </div>
-            <span class="attach-audio__audio-block">
-                {audio_block}
-                <div class="attach-audio__duration">{duration}</div>
-            </span>
-        </div>
-        '''.format(**args, audio_block=audio_block)
+        return AUDIO_TEMPLATE.render(attach, duration=fmt_time(attach['duration']), audio_block=audio_block)
 
     def handle_voice(self, ctx, attach):
-        args = {**attach, **{'duration': fmt_time(attach['duration'])}}
-
-        return '''
-        <div class="attach attach-voice">
-            <div class="attach-voice__title">Voice message</div>
-            <div class="attach-voice__audio-block">
-                <audio class="attach-voice__audio" controls src="{filename}"></audio>
-                <div class="attach-voice__duration">{duration}</div>
-            </div>
-        </div>
-        '''.format(**args)
+        return VOICE_TEMPLATE.render(attach, duration=fmt_time(attach['duration']))
 
     def handle_doc(self, ctx, attach):
-        args = {**attach, **{
-            'filename': attach['filename'] or attach["url"],
-            'size': fmt_size(attach['size'])
-        }}
-
-        return '''
-        <div class="attach attach-doc">
-            <a href="{filename}" class="attach-doc__link-block">
-                <div class="attach-doc__desc">
-                    <div class="attach-doc__link" title="{title}">{title}</div>
-                    <div class="attach-doc__size">{size}</div>
-                </div>
-            </a>
-        </div>
-        '''.format(**args)
+        return DOC_TEMPLATE.render(attach, filename=attach['filename'] or attach["url"], size=fmt_size(attach['size']))
 
     def handle_gift(self, ctx, attach):
-        return '''
-        <div class="attach attach-gift">
-            <div class="attach-gift__title">Gift</div>
-            <img class="attach-gift__thumbnail" src="{thumbnail}" />
-        </div>
-        '''.format(**attach)
+        return GIFT_TEMPLATE.render(attach)
@@ -0,0 +1,154 @@
+import http.client
+import io
+import sys
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+
+DEFAULT_POOL_SIZE = 8
+MAX_REDIRECTS = 5
+USER_AGENT = 'Python-urllib/%s.%s' % sys.version_info[:2]
+
+
+# the connection goes back to the pool when the response is closed after being read to the end
+class PooledResponse:
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+
+    @property
+    def status(self):
+        return self.response.status
+
+    def info(self):
+        return self.response.headers
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def close(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, conn)
+        else:
+            # the response was not read to the end, this connection cannot be reused
+            self.response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# idle keep-alive connections to each host, so requests do not open a new TCP and TLS connection
+class ConnectionPool:
+    def __init__(self, size=DEFAULT_POOL_SIZE):
+        self.size = size
+        self.idle = dict()
+        self.lock = threading.Lock()
+
+    def acquire(self, key, timeout):
+        with self.lock:
+            connections = self.idle.get(key)
+            if connections:
+                conn = connections.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=timeout), False
+        return http.client.HTTPConnection(host, port, timeout=timeout), False
+
+    def release(self, key, conn):
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.size:
+                connections.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, dict()
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+    def urlopen(self, url, timeout=20, headers=None, data=None):
+        # POST if form data is given, raises urllib.error.HTTPError on error status codes like urllib.request.urlopen
+        request_headers = {'User-Agent': USER_AGENT, 'Accept-Encoding': 'identity'}
+        if data is not None:
+            request_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        if headers is not None:
+            request_headers.update(headers)
+
+        for redirect in range(MAX_REDIRECTS + 1):
+            parsed = urllib.parse.urlsplit(url)
+            if urllib.request.getproxies().get(parsed.scheme):
+                # we do not handle proxies ourselves
+                return urllib.request.urlopen(urllib.request.Request(url, data, request_headers), timeout=timeout)
+
+            key = (parsed.scheme, parsed.hostname, parsed.port)
+            path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+            response, conn = self._request(key, path, timeout, request_headers, data)
+
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('Location'):
+                response.read()
+                self._finish(key, conn, response)
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                if response.status not in (307, 308):
+                    # 307 and 308 repeat the request as it is, other redirects are followed with GET
+                    data = None
+                    request_headers.pop('Content-Type', None)
+                continue
+
+            if response.status >= 400:
+                body = response.read()
+                self._finish(key, conn, response)
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(body))
+
+            return PooledResponse(self, key, conn, response, url)
+
+        raise urllib.error.URLError('Too many redirects for %s' % url)
+
+    def _finish(self, key, conn, response):
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(key, conn)
+
+    def _request(self, key, path, timeout, headers, data):
+        while True:
+            conn, reused = self.acquire(key, timeout)
+            try:
+                conn.request('GET' if data is None else 'POST', path, body=data, headers=headers)
+                return conn.getresponse(), conn
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if not reused:
+                    raise
+                # server has closed an idle connection, try again with a new one
+            except Exception:
+                conn.close()
+                raise
+
+
+http_pool = ConnectionPool()
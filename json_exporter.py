@@ -1,16 +1,133 @@
+import codecs
 import json
+import os
 
 
+def indent_json(obj, indent):
+    # same as json.dumps(..., indent=2) of an object nested indent levels deep
+    return json.dumps(obj, ensure_ascii=False, indent=2).replace('\n', '\n' + '  ' * indent)
+
+
+# messages are written one by one as they are exported, the users map goes after all of them
 class JSONExporter:
     def __init__(self, options):
         self.options = options
+        self.file = None
+        self.state = None
+        self.has_messages = False
+        self.existing_users = dict()
 
     @property
     def extension(self):
         return "json"
 
-    def export(self, json_input, progress):
-        return {
-            'text': json.dumps(json_input, ensure_ascii=False, indent=2)
+    def get_filename(self, dialog_id):
+        return os.path.join(self.options.output_dir, '%s.%s' % (dialog_id, self.extension))
+
+    def can_resume(self, state):
+        return 'messages_end' in state.output
+
+    def begin(self, dialog_id, progress, state, resume):
+        self.state = state
+        self.existing_users = dict()
+
+        if resume:
+            self.file = codecs.open(self.get_filename(dialog_id), 'r+', encoding='utf-8')
+
+            # users map is written after all messages, we are going to write it again after new messages
+            if 'users' in state.output:
+                # a previous resumed export has been interrupted after the users map was cut off the file
+                self.existing_users = state.output['users']
+            else:
+                self.file.seek(state.output['users_start'])
+                users_text = self.file.read()
+                self.existing_users = json.loads(users_text[:users_text.rindex('}')])
+
+            # the only copy of the users map is about to be truncated, so it is kept in the state until the file
+            # is complete again
+            state.output = {
+                'messages_end': state.output['messages_end'],
+                'users': self.existing_users
+            }
+            state.save()
+
+            self.file.seek(state.output['messages_end'])
+            self.file.truncate()
+            self.has_messages = state.message_count > 0
+        else:
+            self.file = codecs.open(self.get_filename(dialog_id), 'w', encoding='utf-8')
+            self.file.write('{\n  "messages": [')
+            self.has_messages = False
+
+    def write_message(self, msg, users):
+        self.file.write((',\n    ' if self.has_messages else '\n    ') + indent_json(msg, 2))
+        self.has_messages = True
+
+    def end(self, users):
+        messages_end = self.file.tell()
+        self.file.write('\n  ],\n  "users": ' if self.has_messages else '],\n  "users": ')
+        users_start = self.file.tell()
+
+        # json object keys are always strings
+        all_users = dict((int(user_id), user) for user_id, user in self.existing_users.items())
+        all_users.update(users)
+        self.file.write(indent_json(all_users, 1) + '\n}')
+        self.file.close()
+        self.file = None
+
+        self.state.output = {
+            'messages_end': messages_end,
+            'users_start': users_start
+        }
+
+
+# a message per line, the users map is written into a separate file
+class JSONLinesExporter:
+    def __init__(self, options):
+        self.options = options
+        self.file = None
+        self.state = None
+        self.users_filename = None
+        self.existing_users = dict()
+
+    @property
+    def extension(self):
+        return "jsonl"
+
+    def get_filename(self, dialog_id):
+        return os.path.join(self.options.output_dir, '%s.%s' % (dialog_id, self.extension))
+
+    def can_resume(self, state):
+        return 'messages_end' in state.output
+
+    def begin(self, dialog_id, progress, state, resume):
+        self.state = state
+        self.users_filename = os.path.join(self.options.output_dir, '%s.users.json' % dialog_id)
+        self.existing_users = dict()
+
+        if resume:
+            if os.path.exists(self.users_filename):
+                with codecs.open(self.users_filename, 'r', encoding='utf-8') as f:
+                    self.existing_users = json.load(f)
+
+            # drop everything written after the last complete export
+            self.file = codecs.open(self.get_filename(dialog_id), 'r+', encoding='utf-8')
+            self.file.seek(state.output['messages_end'])
+            self.file.truncate()
+        else:
+            self.file = codecs.open(self.get_filename(dialog_id), 'w', encoding='utf-8')
+
+    def write_message(self, msg, users):
+        self.file.write(json.dumps(msg, ensure_ascii=False) + '\n')
+
+    def end(self, users):
+        self.state.output = {
+            'messages_end': self.file.tell()
         }
+        self.file.close()
+        self.file = None
 
+        all_users = dict((int(user_id), user) for user_id, user in self.existing_users.items())
+        all_users.update(users)
+        with codecs.open(self.users_filename, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(all_users, ensure_ascii=False, indent=2))
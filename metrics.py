@@ -0,0 +1,129 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+METRICS_DIRNAME = 'metrics'
+
+
+# timers sum up durations of repeated operations, gauges keep the last and the maximum value
+class MetricSet:
+    def __init__(self):
+        self.timers = dict()
+        self.counters = dict()
+        self.gauges = dict()
+
+    def add_time(self, name, seconds, count=1):
+        timer = self.timers.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        timer['count'] += count
+        timer['seconds'] += seconds
+        timer['max_seconds'] = max(timer['max_seconds'], seconds if count == 1 else 0.0)
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name, value):
+        gauge = self.gauges.setdefault(name, {'last': 0, 'max': 0})
+        gauge['last'] = value
+        gauge['max'] = max(gauge['max'], value)
+
+    def merge(self, data):
+        # adds metrics of a dialog exported by a worker process
+        for name, timer in data['timers'].items():
+            own = self.timers.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            own['count'] += timer['count']
+            own['seconds'] += timer['seconds']
+            own['max_seconds'] = max(own['max_seconds'], timer['max_seconds'])
+        for name, value in data['counters'].items():
+            self.count(name, value)
+        for name, gauge in data['gauges'].items():
+            own = self.gauges.setdefault(name, {'last': 0, 'max': 0})
+            own['last'] = gauge['last']
+            own['max'] = max(own['max'], gauge['max'])
+
+    def to_dict(self):
+        return {
+            'timers': dict(sorted(self.timers.items())),
+            'counters': dict(sorted(self.counters.items())),
+            'gauges': dict(sorted(self.gauges.items()))
+        }
+
+
+# download threads record metrics too, so all changes are made under a lock
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.run = MetricSet()
+        self.dialog = MetricSet()
+        self.dialogs = dict()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started_at)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.run.add_time(name, seconds)
+            self.dialog.add_time(name, seconds)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.run.count(name, value)
+            self.dialog.count(name, value)
+
+    def set_gauge(self, name, value):
+        with self.lock:
+            self.run.set_gauge(name, value)
+            self.dialog.set_gauge(name, value)
+
+    def start_dialog(self):
+        with self.lock:
+            self.dialog = MetricSet()
+
+    def finish_dialog(self, dialog_id):
+        with self.lock:
+            data = self.dialog.to_dict()
+            self.dialogs[str(dialog_id)] = data
+            return data
+
+    def add_dialog(self, dialog_id, data):
+        with self.lock:
+            self.run.merge(data)
+            self.dialogs[str(dialog_id)] = data
+
+    @staticmethod
+    def get_dir(output_dir):
+        metrics_dir = os.path.join(output_dir, METRICS_DIRNAME)
+        os.makedirs(metrics_dir, exist_ok=True)
+        return metrics_dir
+
+    @staticmethod
+    def save_dialog(output_dir, dialog_id, data):
+        with open(os.path.join(Metrics.get_dir(output_dir), '%s.json' % dialog_id), 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+
+    def save_run(self, output_dir):
+        # each run gets its own file, so runs can be compared
+        finished_at = time.time()
+        with self.lock:
+            data = {
+                'started_at': self.started_at,
+                'finished_at': finished_at,
+                'seconds': finished_at - self.started_at,
+                **self.run.to_dict(),
+                'dialogs': self.dialogs
+            }
+
+        filename = 'run-%s.json' % time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))
+        with open(os.path.join(self.get_dir(output_dir), filename), 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+
+
+metrics = Metrics()
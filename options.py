@@ -1,13 +1,14 @@
 import argparse
 import os
 import sys
+from api import API_BASE_URL
 
 
-FORMAT_EXPORTERS = ['html', 'json']
+FORMAT_EXPORTERS = ['html', 'json', 'jsonl', 'sqlite']
 
 
 class Options:
-    def __init__(self):
+    def __init__(self, argv=None):
         parser = argparse.ArgumentParser(description="Exports VK.COM messages into HTML files. "
                                                      "Login and password should be specified in config.ini file")
         parser.add_argument('--person', type=int, dest="person", help="ID of person whose dialog you want to export")
@@ -23,13 +24,53 @@ class Options:
                             "to 1, audio file from attached posts are going to be downloaded too, and so on. Default is 100")
         parser.add_argument('--no-voice', dest="no_voice", default=False, action="store_true",
                             help="Do not download voice messages")
+        parser.add_argument('--download-workers', dest="download_workers", default=4, type=int,
+                            help="Number of attachments downloaded simultaneously. Default is 4, set to 1 to download "
+                            "files one by one")
+        parser.add_argument('--http-pool-size', dest="http_pool_size", default=8, type=int,
+                            help="Maximum number of idle connections kept open to each host. Default is 8")
+        parser.add_argument('--execute-batch', dest="execute_batch", default=25, type=int,
+                            help="Number of message history pages (200 messages each) fetched in one request with the "
+                            "execute method. Maximum and default is 25, set to 1 to fetch pages one by one")
+        parser.add_argument('--profile-cache-ttl', dest="profile_cache_ttl", default=24, type=float,
+                            help="User and group profiles are cached in the output directory and reused by next runs. "
+                            "Cached profiles older than this number of hours are requested again. Default is 24, "
+                            "set to 0 to disable the cache")
+        parser.add_argument('--incremental', dest="incremental", default=False, action="store_true",
+                            help="Fetch only messages sent after the previous export of a dialog and append them to "
+                            "existing output files")
+        parser.add_argument('--api-rate', dest="api_rate", default=3, type=float,
+                            help="Maximum number of API requests per second. Default is 3, the limit VK sets for user tokens")
+        parser.add_argument('--dedup', dest="dedup", default=False, action="store_true",
+                            help="Store each downloaded file only once for all dialogs. Files are kept in .blobs "
+                            "directory of the output directory, dialog directories contain hardlinks to them")
+        parser.add_argument('--jobs', dest="jobs", default=1, type=int,
+                            help="Number of dialogs exported simultaneously in separate processes. All processes share "
+                            "the same API rate limit. Default is 1")
+        parser.add_argument('--api-url', dest="api_url", default=API_BASE_URL, type=str,
+                            help="Base URL of VK API methods, can be changed to run the script against a local mock "
+                            "server (see bench/mock_vk.py)")
+        parser.add_argument('--metrics', dest="metrics", default=False, action="store_true",
+                            help="Save timings of export stages and API methods, numbers of API calls, retries, "
+                            "downloaded bytes and cache hits into JSON files in metrics directory of the output "
+                            "directory, one file per run and one file per dialog")
+        parser.add_argument('--profile', dest="profile", default=False, action="store_true",
+                            help="Profile export of each dialog with cProfile and tracemalloc, pstats files and reports "
+                            "on the largest allocations are saved into profile directory of the output directory")
         parser.add_argument('--out', dest="out", default="out", type=str, help="Directory for output files")
-        parser.add_argument('--format', dest='format', default="html", type=str, help="Output format (html, json)")
+        parser.add_argument('--format', dest='format', default="html", type=str, help="Output format (html, json, jsonl, sqlite)")
+        parser.add_argument('--html-split', dest='html_split', default=None, type=str,
+                            help="Split HTML output of each dialog into pages with an index page. Use a number to put "
+                            "this number of messages on each page, or 'month' to put messages of each month "
+                            "on a separate page")
         parser.add_argument('--save-raw', dest="save_raw", default=False, action='store_true', help="Save raw API responses in json")
         parser.add_argument('--save-json-in-html', dest="save_json_in_html", default=False, action='store_true', help="Store messages JSON in HTML output")
+        parser.add_argument('--no-search-index', dest='no_search_index', default=False, action='store_true',
+                            help="Do not build the index of words used in messages that lets exported HTML pages search "
+                            "the whole dialog")
         parser.add_argument('--embed-resources', dest='embed_resources', default=False, action='store_true', help="Embed styles and scripts in generated HTML file")
 
-        self.arguments = parser.parse_args()
+        self.arguments = parser.parse_args(argv)
 
         self.output_dir = self.arguments.out
         self.output_dir = os.path.abspath(os.path.expandvars(self.output_dir))
@@ -44,6 +85,21 @@ class Options:
         if self.arguments.embed_resources and self.output_format != 'html':
             sys.stderr.write("--embed-resources is not allowed when output format is not HTML")
 
+        self.html_split = None
+        if self.arguments.html_split is not None:
+            if self.output_format != 'html':
+                sys.stderr.write("--html-split is not allowed when output format is not HTML")
+            elif self.arguments.html_split == 'month':
+                self.html_split = 'month'
+            elif self.arguments.html_split.isdigit() and int(self.arguments.html_split) > 0:
+                self.html_split = int(self.arguments.html_split)
+            else:
+                sys.stderr.write("Invalid value for --html-split: %s" % self.arguments.html_split)
+
+        if self.arguments.api_rate <= 0:
+            sys.stderr.write("Invalid value for --api-rate: %s, it should be greater than 0\n" % self.arguments.api_rate)
+            sys.exit(-1)
+
         if not (self.output_format in FORMAT_EXPORTERS):
             sys.stderr.write("Unknown format: %s" % self.output_format)
 
@@ -0,0 +1,40 @@
+import json
+import sqlite3
+import time
+from utils import chunks
+
+
+PROFILE_CACHE_FILENAME = 'profiles.sqlite'
+
+
+# profiles of users and groups kept between runs, profiles older than ttl seconds are requested again. Group profiles
+# are stored with negative ids
+class ProfileCache:
+    def __init__(self, filename, ttl):
+        self.ttl = ttl
+        self.db = sqlite3.connect(filename, timeout=60)
+        # parallel export opens the cache from several processes, WAL lets them read while one of them writes
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS profiles ('
+                        'id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)')
+        self.db.commit()
+
+    def get_many(self, user_ids):
+        result = dict()
+        min_updated_at = time.time() - self.ttl
+        for chunk in chunks(list(user_ids), 500):
+            rows = self.db.execute('SELECT id, data FROM profiles WHERE updated_at >= ? AND id IN (%s)'
+                                   % ','.join('?' * len(chunk)), [min_updated_at] + chunk)
+            for user_id, data in rows:
+                result[user_id] = json.loads(data)
+        return result
+
+    def put_many(self, profiles):
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO profiles (id, data, updated_at) VALUES (?, ?, ?)',
+                                [(user_id, json.dumps(data, ensure_ascii=False), now) for user_id, data in profiles.items()])
+
+    def close(self):
+        self.db.close()
+
@@ -0,0 +1,85 @@
+import contextlib
+import cProfile
+import os
+import tracemalloc
+from utils import fmt_size
+
+
+PROFILE_DIRNAME = 'profile'
+PROFILE_TOP_ALLOCATIONS = 30
+# stages with allocation reports, writing messages is interleaved with fetching them, so it is a part of export
+ALLOCATION_STAGES = ('export', 'finish')
+
+
+def take_snapshot():
+    # snapshots themselves are allocated while tracing, they should not show up in reports
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+# writing messages is profiled as a separate stage
+class ProfiledWriter:
+    def __init__(self, writer, profiler):
+        self.writer = writer
+        self.profiler = profiler
+
+    def write_message(self, msg, users):
+        with self.profiler.stage('write'):
+            self.writer.write_message(msg, users)
+
+
+# only one cProfile profiler can be active at a time, so a nested stage pauses the outer one. Before Python 3.12
+# cProfile profiles only the exporting thread, since 3.12 it records all threads, so stages include background downloads
+class DialogProfiler:
+    def __init__(self):
+        self.profiles = dict()
+        self.allocations = dict()
+        self.stack = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.stack:
+            self.profiles[self.stack[-1]].disable()
+        self.stack.append(name)
+
+        trace_allocations = name in ALLOCATION_STAGES
+        if trace_allocations:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            snapshot = take_snapshot()
+
+        profile = self.profiles.setdefault(name, cProfile.Profile())
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            if trace_allocations:
+                peak = tracemalloc.get_traced_memory()[1]
+                stats = take_snapshot().compare_to(snapshot, 'lineno')
+                self.allocations[name] = (peak, stats[:PROFILE_TOP_ALLOCATIONS])
+
+            self.stack.pop()
+            if self.stack:
+                self.profiles[self.stack[-1]].enable()
+
+    def wrap_writer(self, writer):
+        return ProfiledWriter(writer, self)
+
+    def save(self, output_dir, dialog_id):
+        profile_dir = os.path.join(output_dir, PROFILE_DIRNAME)
+        os.makedirs(profile_dir, exist_ok=True)
+
+        for name, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(profile_dir, '%s.%s.pstats' % (dialog_id, name)))
+
+        with open(os.path.join(profile_dir, '%s.allocations.txt' % dialog_id), 'w', encoding='utf-8') as f:
+            for name, (peak, stats) in self.allocations.items():
+                f.write('Stage %s, peak traced memory %s, top %s lines by allocated memory:\n'
+                        % (name, fmt_size(peak), len(stats)))
+                for stat in stats:
+                    f.write('  %s\n' % stat)
+                f.write('\n')
+
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
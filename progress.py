@@ -1,4 +1,13 @@
 import sys
+import threading
+import time
+from utils import fmt_size, fmt_time
+
+
+# the status line is repainted at most 5 times per second
+REPAINT_INTERVAL = 0.2
+# when output is redirected into a file, a separate status line is written every 10 seconds instead
+LINE_INTERVAL = 10
 
 
 class Progress:
@@ -6,36 +15,108 @@ class Progress:
     cur_stage = 0
     steps_on_this_stage = 0
     cur_step_on_this_stage = 0
-    msg = ''
+    # worker processes of a parallel export keep quiet, only the main process draws the progress bar
+    quiet = False
+    # what steps of a stage are, used to display the speed
+    unit = 'msg'
+
+    def __init__(self):
+        # attachments are downloaded from several threads, each of them can report its own step message
+        self.lock = threading.RLock()
+        self.step_msgs = dict()
+        self.is_tty = sys.stdout.isatty()
+        self.painted_at = 0
+        # speed and ETA are measured from the first update of a stage
+        self.stage_started_at = None
+        self.stage_first_step = 0
+        self.stage_bytes = 0
 
     def next_stage(self):
-        if self.steps_on_this_stage != 0:
-            self.update(self.steps_on_this_stage, self.steps_on_this_stage)
-        sys.stdout.write('\n')
-        sys.stdout.flush()
-        self.cur_stage += 1
+        with self.lock:
+            if self.steps_on_this_stage != 0:
+                self.cur_step_on_this_stage = self.steps_on_this_stage
+            self._update(True)
+            if not self.quiet and self.is_tty:
+                sys.stdout.write('\n')
+                sys.stdout.flush()
+            self.cur_stage += 1
+            self.stage_started_at = None
+            self.stage_bytes = 0
 
     def update(self, steps, total_steps):
-        self.steps_on_this_stage = total_steps
-        self.cur_step_on_this_stage = steps
-        self._update()
+        with self.lock:
+            if self.stage_started_at is None:
+                self.stage_started_at = time.monotonic()
+                self.stage_first_step = steps
+            self.steps_on_this_stage = total_steps
+            self.cur_step_on_this_stage = steps
+            self._update()
+
+    def add_bytes(self, count):
+        with self.lock:
+            self.stage_bytes += count
+
+    @property
+    def msg(self):
+        if not self.step_msgs:
+            return ''
+        last = next(reversed(self.step_msgs.values()))
+        if len(self.step_msgs) > 1:
+            return '%s (+%s more)' % (last, len(self.step_msgs) - 1)
+        return last
+
+    @property
+    def speed_text(self):
+        if self.stage_started_at is None:
+            return ''
+        elapsed = time.monotonic() - self.stage_started_at
+        done = self.cur_step_on_this_stage - self.stage_first_step
+        if elapsed <= 0 or done <= 0:
+            return ''
+
+        speed = done / elapsed
+        text = ' %.1f %s/s' % (speed, self.unit)
+        if self.stage_bytes > 0:
+            text += ', %s/s' % fmt_size(self.stage_bytes / elapsed)
+        if self.cur_step_on_this_stage < self.steps_on_this_stage:
+            text += ', ETA %s' % fmt_time(int((self.steps_on_this_stage - self.cur_step_on_this_stage) / speed))
+        return text
 
     def step_msg(self, msg):
-        self.msg = msg
-        self._update()
+        with self.lock:
+            thread_id = threading.get_ident()
+            self.step_msgs.pop(thread_id, None)
+            if msg:
+                self.step_msgs[thread_id] = msg
+            self._update()
 
     def clear_step_msg(self):
         self.step_msg('')
 
     def error(self, msg):
-        sys.stdout.write('\r' + msg)
-        self._update()
+        with self.lock:
+            sys.stdout.write(msg if self.quiet or not self.is_tty else '\r' + msg)
+            # the status line has just been overwritten, so it is repainted right away
+            self._update(self.is_tty)
+
+    def _update(self, force=False):
+        # calls made too soon after the previous repaint are ignored unless force is set
+        if self.quiet:
+            return
+        now = time.monotonic()
+        if not force and now - self.painted_at < (REPAINT_INTERVAL if self.is_tty else LINE_INTERVAL):
+            return
+        self.painted_at = now
 
-    def _update(self):
-        percent = (float(self.cur_step_on_this_stage) / float(self.steps_on_this_stage)) * 100
+        percent = (float(self.cur_step_on_this_stage) / float(self.steps_on_this_stage)) * 100 if self.steps_on_this_stage else 0
         title = '%s of %s' % (self.cur_stage + 1, self.total_stages)
         steps_text = '(%s / %s)' % (self.cur_step_on_this_stage, self.steps_on_this_stage)
-        msg_text = ' | ' + self.msg if self.msg else ''
-        text = title.ljust(10) + ' [' + ('#' * int((5 * round(float(percent)) / 5) / 5)).ljust(20) + '] ' + steps_text + msg_text
-        sys.stdout.write('\r' + text)
+        msg = self.msg
+        msg_text = ' | ' + msg if msg else ''
+        text = title.ljust(10) + ' [' + ('#' * int((5 * round(float(percent)) / 5) / 5)).ljust(20) + '] ' + steps_text \
+            + self.speed_text + msg_text
+        if self.is_tty:
+            sys.stdout.write('\r' + text)
+        else:
+            sys.stdout.write(text + '\n')
         sys.stdout.flush()
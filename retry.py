@@ -0,0 +1,105 @@
+import http.client
+import json
+import random
+import socket
+import ssl
+import threading
+import time
+import urllib.error
+
+
+# HTTP statuses that usually mean a server is overloaded or restarting, a request can succeed later
+TRANSIENT_HTTP_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def is_transient_error(error):
+    # network and server-side errors can go away on retry, other HTTP errors like 403 or 404 can not
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in TRANSIENT_HTTP_STATUSES
+    return isinstance(error, (urllib.error.URLError, socket.timeout, socket.gaierror, ssl.SSLError, ConnectionError,
+                              http.client.HTTPException, json.JSONDecodeError))
+
+
+# capped exponential backoff with jitter, permanent errors are raised immediately
+class RetryPolicy:
+    def __init__(self, attempts, base_delay, max_delay, is_transient=is_transient_error):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.is_transient = is_transient
+
+    def get_delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+        # jitter prevents simultaneous requests from retrying at the same moment
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def run(self, func, on_retry=None, breaker=None):
+        attempt = 0
+        while True:
+            if breaker is not None:
+                breaker.check()
+
+            try:
+                result = func()
+            except Exception as error:
+                transient = self.is_transient(error)
+                if breaker is not None and transient:
+                    breaker.record_failure()
+
+                attempt += 1
+                if not transient or attempt >= self.attempts:
+                    raise
+
+                delay = self.get_delay(attempt - 1)
+                if on_retry is not None:
+                    on_retry(error, delay)
+                time.sleep(delay)
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                return result
+
+
+# stops requests to a host after too many consecutive failures, after a cooldown a single failure opens it again
+class CircuitBreaker:
+    def __init__(self, host, threshold, cooldown):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def check(self):
+        with self.lock:
+            if self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown:
+                raise CircuitOpenError('Host %s is not responding, skipping request' % self.host)
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+
+class CircuitBreakers:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.breakers = dict()
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(host, self.threshold, self.cooldown)
+            return self.breakers[host]
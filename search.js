@@ -0,0 +1,109 @@
+(function () {
+  var MAX_RESULTS = 100;
+
+  // the same words the exporter puts into the index: lowercase letters, digits and underscores, at least 2 characters
+  function tokenize(text) {
+    return (text.toLowerCase().match(/[\p{L}\p{N}_]+/gu) || []).filter(function (token) {
+      return token.length >= 2;
+    });
+  }
+
+  function decode(deltas) {
+    var result = new Array(deltas.length);
+    var prev = 0;
+    for (var i = 0; i < deltas.length; i++) {
+      prev += deltas[i];
+      result[i] = prev;
+    }
+    return result;
+  }
+
+  function init() {
+    var form = document.querySelector('.search');
+    if (!form || typeof searchIndex === 'undefined') {
+      return;
+    }
+
+    var input = form.querySelector('.search__input');
+    var results = form.querySelector('.search__results');
+    var index = searchIndex;
+    var pages = decode(index.page);
+    var ids = decode(index.id);
+    var dates = decode(index.date);
+    var words = Object.keys(index.tokens);
+    var decoded = {};
+
+    function getPostings(token) {
+      if (!(token in decoded)) {
+        decoded[token] = decode(index.tokens[token]);
+      }
+      return decoded[token];
+    }
+
+    // the last word of the query may be typed partially, so it matches all words starting with it
+    function findMessages(token, isPrefix) {
+      if (!isPrefix) {
+        return new Set(index.tokens.hasOwnProperty(token) ? getPostings(token) : []);
+      }
+      var found = new Set();
+      for (var i = 0; i < words.length; i++) {
+        if (words[i].lastIndexOf(token, 0) === 0) {
+          getPostings(words[i]).forEach(function (number) {
+            found.add(number);
+          });
+        }
+      }
+      return found;
+    }
+
+    function search(query) {
+      var tokens = tokenize(query);
+      if (tokens.length === 0) {
+        return [];
+      }
+      var found = null;
+      for (var i = 0; i < tokens.length; i++) {
+        var messages = findMessages(tokens[i], i === tokens.length - 1);
+        found = found === null ? messages : new Set(Array.from(found).filter(function (number) {
+          return messages.has(number);
+        }));
+      }
+      return Array.from(found).sort(function (a, b) {
+        return a - b;
+      });
+    }
+
+    function render() {
+      var found = search(input.value);
+      results.innerHTML = '';
+      if (input.value.trim() === '') {
+        return;
+      }
+
+      var count = document.createElement('div');
+      count.className = 'search__count';
+      count.textContent = found.length + ' messages found' + (found.length > MAX_RESULTS ? ', showing first ' + MAX_RESULTS : '');
+      results.appendChild(count);
+
+      found.slice(0, MAX_RESULTS).forEach(function (number) {
+        var link = document.createElement('a');
+        link.className = 'search__result';
+        link.href = index.pages[pages[number]] + '#m' + ids[number];
+        link.textContent = new Date(dates[number] * 1000).toLocaleString();
+        results.appendChild(link);
+      });
+    }
+
+    var timer = null;
+    input.addEventListener('input', function () {
+      clearTimeout(timer);
+      timer = setTimeout(render, 150);
+    });
+  }
+
+  if (document.readyState === 'loading') {
+    document.addEventListener('DOMContentLoaded', init);
+  } else {
+    init();
+  }
+})();
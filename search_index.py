@@ -0,0 +1,120 @@
+import array
+import codecs
+import html
+import json
+import os
+import re
+
+
+SEARCH_INDEX_PREFIX = 'var searchIndex = '
+SEARCH_INDEX_SUFFIX = ';\n'
+# words shorter than 2 characters are too common to be worth indexing
+TOKEN_RE = re.compile(r'\w{2,}')
+TAG_RE = re.compile(r'<[^>]*>')
+
+
+def tokenize(text):
+    # message text comes with HTML entities and <br> tags, they are removed first
+    return TOKEN_RE.findall(html.unescape(TAG_RE.sub(' ', text)).lower())
+
+
+def delta_encode(numbers):
+    result = []
+    prev = 0
+    for number in numbers:
+        result.append(number - prev)
+        prev = number
+    return result
+
+
+def delta_decode(deltas):
+    result = []
+    prev = 0
+    for delta in deltas:
+        prev += delta
+        result.append(prev)
+    return result
+
+
+# words are mapped to numbers of messages they are used in, saved as differences between adjacent numbers to keep the
+# script loaded by pages compact
+class SearchIndex:
+    def __init__(self):
+        self.pages = []
+        self.page_numbers = dict()
+        # page number, id and date of each message
+        self.message_pages = array.array('l')
+        self.message_ids = array.array('q')
+        self.message_dates = array.array('q')
+        self.postings = dict()
+
+    @staticmethod
+    def get_filename(output_dir, dialog_id):
+        return os.path.join(output_dir, '%s.search.js' % dialog_id)
+
+    def add(self, page, msg_id, date, texts):
+        page_number = self.page_numbers.get(page)
+        if page_number is None:
+            page_number = self.page_numbers[page] = len(self.pages)
+            self.pages.append(page)
+
+        number = self.message_count
+        self.message_pages.append(page_number)
+        self.message_ids.append(msg_id)
+        self.message_dates.append(date)
+
+        for text in texts:
+            for token in tokenize(text):
+                postings = self.postings.get(token)
+                if postings is None:
+                    self.postings[token] = array.array('l', [number])
+                elif postings[-1] != number:
+                    postings.append(number)
+
+    @property
+    def message_count(self):
+        return len(self.message_ids)
+
+    def truncate(self, count):
+        # forgets messages added after the first count messages
+        del self.message_pages[count:]
+        del self.message_ids[count:]
+        del self.message_dates[count:]
+        for token in list(self.postings):
+            postings = self.postings[token]
+            while len(postings) > 0 and postings[-1] >= count:
+                postings.pop()
+            if len(postings) == 0:
+                del self.postings[token]
+
+    def get_script(self):
+        data = {
+            'pages': self.pages,
+            'page': delta_encode(self.message_pages),
+            'id': delta_encode(self.message_ids),
+            'date': delta_encode(self.message_dates),
+            'tokens': dict((token, delta_encode(self.postings[token])) for token in sorted(self.postings))
+        }
+
+        return SEARCH_INDEX_PREFIX + json.dumps(data, ensure_ascii=False, separators=(',', ':')) + SEARCH_INDEX_SUFFIX
+
+    def save(self, filename, script=None):
+        with codecs.open(filename, 'w', encoding='utf-8') as f:
+            f.write(script if script is not None else self.get_script())
+
+    @classmethod
+    def load(cls, filename):
+        index = cls()
+        if not os.path.exists(filename):
+            return index
+
+        with codecs.open(filename, 'r', encoding='utf-8') as f:
+            data = json.loads(f.read()[len(SEARCH_INDEX_PREFIX):-len(SEARCH_INDEX_SUFFIX)])
+
+        index.pages = data['pages']
+        index.page_numbers = dict((page, number) for number, page in enumerate(index.pages))
+        index.message_pages = array.array('l', delta_decode(data['page']))
+        index.message_ids = array.array('q', delta_decode(data['id']))
+        index.message_dates = array.array('q', delta_decode(data['date']))
+        index.postings = dict((token, array.array('l', delta_decode(deltas))) for token, deltas in data['tokens'].items())
+        return index
@@ -0,0 +1,183 @@
+import json
+import os
+import sqlite3
+import sys
+
+
+SQLITE_FILENAME = 'messages.sqlite'
+# messages are kept in memory and written in batches, each batch in a single short transaction. A transaction
+# per message would make writing many times slower, and a transaction kept open while messages are fetched and
+# attachments are downloaded would block other processes of a parallel export
+SQLITE_BATCH_SIZE = 1000
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS users ('
+    'id INTEGER PRIMARY KEY, name TEXT, first_name TEXT, last_name TEXT, link TEXT, filename TEXT)',
+    # forwarded messages are stored as messages too, they are linked to messages they are forwarded with
+    # in forwarded table
+    'CREATE TABLE IF NOT EXISTS messages ('
+    'id INTEGER PRIMARY KEY, dialog_id INTEGER NOT NULL, vk_id INTEGER NOT NULL, is_forwarded INTEGER NOT NULL, '
+    'date INTEGER, sender_id INTEGER, text TEXT, is_important INTEGER, is_updated INTEGER, updated_at INTEGER, '
+    'action TEXT, action_text TEXT, action_mid INTEGER, raw TEXT)',
+    'CREATE INDEX IF NOT EXISTS messages_dialog ON messages (dialog_id, date)',
+    'CREATE TABLE IF NOT EXISTS forwarded ('
+    'message_id INTEGER NOT NULL REFERENCES messages (id), '
+    'forwarded_id INTEGER NOT NULL REFERENCES messages (id), position INTEGER NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS forwarded_message ON forwarded (message_id)',
+    # attachments of posts and reposts refer to the post they belong to with parent_id
+    'CREATE TABLE IF NOT EXISTS attachments ('
+    'id INTEGER PRIMARY KEY, message_id INTEGER NOT NULL REFERENCES messages (id), '
+    'parent_id INTEGER REFERENCES attachments (id), relation TEXT NOT NULL, position INTEGER NOT NULL, '
+    'type TEXT NOT NULL, filename TEXT, url TEXT, title TEXT, text TEXT, data TEXT)',
+    'CREATE INDEX IF NOT EXISTS attachments_message ON attachments (message_id)',
+    # text indexed for each message: its own text and text of posts attached to it
+    'CREATE VIEW IF NOT EXISTS search_text AS SELECT id, text, ('
+    'SELECT group_concat(text, char(10)) FROM ('
+    "SELECT text FROM attachments WHERE attachments.message_id = messages.id AND type = 'post' AND text != '' "
+    'ORDER BY id)) AS posts FROM messages'
+]
+
+# the index does not store the text, it is read from search_text, and its rows are messages.id, so rows
+# of a message are found without scanning the index
+FTS_SCHEMA = 'CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(' \
+             'text, posts, content="search_text", content_rowid="id", tokenize="unicode61 remove_diacritics 2")'
+# SQLite can be built without FTS5, search is a view of the same text then, it can be searched with LIKE
+FALLBACK_SEARCH_SCHEMA = 'CREATE VIEW IF NOT EXISTS search AS SELECT id, text, posts FROM search_text'
+
+
+# messages of all dialogs go into one database, text is added to a full-text index:
+#     SELECT messages.* FROM search JOIN messages ON messages.id = search.rowid WHERE search MATCH 'word'
+class SQLiteExporter:
+    def __init__(self, options):
+        self.options = options
+        self.db = None
+        self.state = None
+        self.dialog_id = None
+        self.has_fts = False
+        self.pending = []
+
+    @property
+    def extension(self):
+        return "sqlite"
+
+    def get_filename(self, dialog_id):
+        # all dialogs share the same database
+        return os.path.join(self.options.output_dir, SQLITE_FILENAME)
+
+    def can_resume(self, state):
+        return 'last_row_id' in state.output
+
+    def open_database(self):
+        # parallel export writes into the same database from several processes, they wait for each other's batches
+        db = sqlite3.connect(self.get_filename(self.dialog_id), timeout=600)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        for statement in SCHEMA:
+            db.execute(statement)
+        self.has_fts = self.create_search_index(db)
+        db.commit()
+        return db
+
+    def create_search_index(self, db):
+        # returns False if SQLite is built without FTS5
+        existing = db.execute("SELECT sql FROM sqlite_master WHERE name = 'search'").fetchone()
+        rebuild = existing is not None and 'search_text' not in existing[0]
+        if rebuild:
+            # the index of older versions had a row for each message and post, it is built again from stored text
+            db.execute('DROP TABLE search')
+        try:
+            db.execute(FTS_SCHEMA)
+        except sqlite3.OperationalError:
+            sys.stdout.write('SQLite is built without FTS5, full-text index is not created\n')
+            db.execute(FALLBACK_SEARCH_SCHEMA)
+            return False
+        if rebuild:
+            db.execute("INSERT INTO search (search) VALUES ('rebuild')")
+        return True
+
+    def begin(self, dialog_id, progress, state, resume):
+        # removes messages that are going to be written again, all of them for a full export, or the ones written after
+        # the previous complete export when resuming
+        self.dialog_id = dialog_id
+        self.state = state
+        self.pending = []
+        self.db = self.open_database()
+        self.delete_messages(state.output['last_row_id'] if resume else 0)
+
+    def delete_messages(self, after_row_id):
+        with self.db:
+            selected = 'SELECT id FROM messages WHERE dialog_id = ? AND id > ?'
+            params = (self.dialog_id, after_row_id)
+            if self.has_fts:
+                # the index does not keep the text, the same text that was indexed has to be passed to delete rows
+                self.db.execute("INSERT INTO search (search, rowid, text, posts) "
+                                "SELECT 'delete', id, text, posts FROM search_text WHERE id IN (%s)" % selected,
+                                params)
+            self.db.execute('DELETE FROM attachments WHERE message_id IN (%s)' % selected, params)
+            self.db.execute('DELETE FROM forwarded WHERE message_id IN (%s)' % selected, params)
+            self.db.execute('DELETE FROM messages WHERE dialog_id = ? AND id > ?', params)
+
+    def insert_message(self, msg, is_forwarded):
+        row_id = self.db.execute(
+            'INSERT INTO messages (dialog_id, vk_id, is_forwarded, date, sender_id, text, is_important, is_updated, '
+            'updated_at, action, action_text, action_mid, raw) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (self.dialog_id, msg['id'], is_forwarded, msg['date'], msg['sender']['id'], msg['message'],
+             msg['is_important'], msg['is_updated'], msg.get('updated_at'), msg.get('action'), msg.get('action_text'),
+             msg.get('action_mid'), json.dumps(msg['raw'], ensure_ascii=False) if 'raw' in msg else None)
+        ).lastrowid
+
+        for position, fwd_msg in enumerate(msg.get('forwarded', [])):
+            self.db.execute('INSERT INTO forwarded (message_id, forwarded_id, position) VALUES (?, ?, ?)',
+                            (row_id, self.insert_message(fwd_msg, True), position))
+
+        posts = []
+        self.insert_attachments(row_id, None, 'attachment', msg.get('attachments', []), posts)
+        if self.has_fts:
+            # the text has to be the same search_text returns for the message, otherwise deleting it would damage
+            # the index. Texts of posts are collected in the order of attachment ids
+            self.db.execute('INSERT INTO search (rowid, text, posts) VALUES (?, ?, ?)',
+                            (row_id, msg['message'], '\n'.join(posts) if posts else None))
+        return row_id
+
+    def insert_attachments(self, message_id, parent_id, relation, attachments, posts):
+        for position, attach in enumerate(attachments):
+            data = dict((key, value) for key, value in attach.items() if key not in ('attachments', 'repost'))
+            text = attach.get('text', attach.get('description', ''))
+            attach_id = self.db.execute(
+                'INSERT INTO attachments (message_id, parent_id, relation, position, type, filename, url, title, '
+                'text, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (message_id, parent_id, relation, position, attach['type'], attach.get('filename'), attach.get('url'),
+                 attach.get('title'), text, json.dumps(data, ensure_ascii=False))
+            ).lastrowid
+
+            if attach['type'] == 'post':
+                if text:
+                    posts.append(text)
+                self.insert_attachments(message_id, attach_id, 'attachment', attach.get('attachments', []), posts)
+                self.insert_attachments(message_id, attach_id, 'repost', attach.get('repost', []), posts)
+
+    def write_message(self, msg, users):
+        self.pending.append(msg)
+        if len(self.pending) >= SQLITE_BATCH_SIZE:
+            self.write_pending()
+
+    def write_pending(self):
+        with self.db:
+            for msg in self.pending:
+                self.insert_message(msg, False)
+        self.pending = []
+
+    def end(self, users):
+        self.write_pending()
+        self.db.executemany('INSERT OR REPLACE INTO users (id, name, first_name, last_name, link, filename) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            [(user_id, user['name'], user['first_name'], user['last_name'], user['link'],
+                              user['filename']) for user_id, user in users.items()])
+        self.db.commit()
+
+        last_row_id = self.db.execute('SELECT MAX(id) FROM messages WHERE dialog_id = ?', (self.dialog_id,)).fetchone()[0]
+        self.state.output = {
+            'last_row_id': last_row_id or 0
+        }
+        self.db.close()
+        self.db = None
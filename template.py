@@ -0,0 +1,54 @@
+import re
+import string
+
+
+# whitespace with line breaks is only there to make template sources readable
+LINE_BREAK_WHITESPACE = re.compile(r'\s*\n\s*')
+
+
+def minify(literal, is_first, is_last):
+    # whitespace between two tags is dropped, other whitespace with line breaks becomes a single space
+    def replace(match):
+        start, end = match.start(), match.end()
+        if (start == 0 and is_first) or (end == len(literal) and is_last):
+            return ''
+        if start > 0 and literal[start - 1] == '>' and end < len(literal) and literal[end] == '<':
+            return ''
+        return ' '
+
+    return LINE_BREAK_WHITESPACE.sub(replace, literal)
+
+
+# str.format template compiled once, field values are taken from keyword arguments first and then from the dict
+class Template:
+    def __init__(self, source):
+        self.source = source
+
+        parsed = list(string.Formatter().parse(source))
+        self.parts = []
+        for index, (literal, field, format_spec, conversion) in enumerate(parsed):
+            if conversion:
+                raise ValueError('Conversions are not supported in templates')
+            literal = minify(literal, index == 0, index == len(parsed) - 1 and field is None)
+            self.parts.append((literal, field, format_spec or ''))
+
+        self.render_parts = self.compile()
+
+    def compile(self):
+        # a single f-string joins literals and looked up fields
+        lines = ['def render_parts(values, extra):']
+        chunks = []
+        for index, (literal, field, format_spec) in enumerate(self.parts):
+            if literal:
+                chunks.append(repr(literal))
+            if field is not None:
+                lines.append('    v%s = extra[%r] if %r in extra else values[%r]' % (index, field, field, field))
+                chunks.append('f' + repr('{v%s%s}' % (index, ':' + format_spec if format_spec else '')))
+        lines.append('    return ' + (' '.join(chunks) or "''"))
+
+        namespace = dict()
+        exec('\n'.join(lines), namespace)
+        return namespace['render_parts']
+
+    def render(self, values=None, **extra):
+        return self.render_parts(values, extra)
@@ -1,16 +1,42 @@
 import datetime
+import functools
 import html
-import os
 
 
+# the local time inside a 15-minute interval is computed by adding seconds to the local time of its start,
+# unless the time zone offset changes inside the interval
+TIMESTAMP_BUCKET_SIZE = 15 * 60
+
+
+@functools.lru_cache(maxsize=1024, typed=True)
 def fmt_time(secs):
     return str(datetime.timedelta(seconds=secs))
 
 
+@functools.lru_cache(maxsize=4096)
+def get_timestamp_bucket(bucket):
+    # None if the 15-minute interval does not start at a round quarter of an hour in the local zone or the zone offset
+    # changes inside it (some zones switched daylight saving time at 00:01)
+    start = datetime.datetime.fromtimestamp(bucket * TIMESTAMP_BUCKET_SIZE)
+    if start.second != 0 or start.minute % 15 != 0:
+        return None
+    end = datetime.datetime.fromtimestamp(bucket * TIMESTAMP_BUCKET_SIZE + TIMESTAMP_BUCKET_SIZE - 1)
+    if end - start != datetime.timedelta(seconds=TIMESTAMP_BUCKET_SIZE - 1):
+        return None
+    return start.strftime('%Y-%m-%d %H:'), start.minute
+
+
 def fmt_timestamp(timestamp):
+    if type(timestamp) is int:
+        bucket, offset = divmod(timestamp, TIMESTAMP_BUCKET_SIZE)
+        start = get_timestamp_bucket(bucket)
+        if start is not None:
+            minutes, seconds = divmod(offset, 60)
+            return '%s%02d:%02d' % (start[0], start[1] + minutes, seconds)
     return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
 
 
+@functools.lru_cache(maxsize=4096, typed=True)
 def fmt_date_diff(diff, add_sign=False):
     units = [('s', 60), ('m', 60), ('h', 24), ('d', 0)]
 
@@ -40,26 +66,23 @@ def fmt_size(size):
     return "%.1f%sB" % (size, 'Yi')
 
 
+def chunks(items, size):
+    for index in range(0, len(items), size):
+        yield items[index:index + size]
+
+
 def esc(text):
     return html.escape(text)
 
 
-def guess_image_ext(content_type):
-    return {
-        'image/jpeg': 'jpg',
-        'image/png': 'png',
-        'image/gif': 'gif'
-    }.get(content_type.lower(), 'jpg')
-
+IMAGE_CONTENT_TYPES = {
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/gif': 'gif'
+}
+# extensions images downloaded with auto_image_ext can get
+IMAGE_EXTENSIONS = sorted(set(IMAGE_CONTENT_TYPES.values()))
 
-def has_downloaded_image(download_dir, filename):
-    def is_downloaded_image(existing_file):
-        return os.path.splitext(existing_file)[0] == filename
 
-    try:
-        downloaded_file = next(f for f in os.listdir(download_dir) if is_downloaded_image(f))
-        if os.stat(os.path.join(download_dir, downloaded_file)).st_size > 0:
-            return downloaded_file
-        return None
-    except StopIteration:
-        return None
+def guess_image_ext(content_type):
+    return IMAGE_CONTENT_TYPES.get(content_type.lower(), 'jpg')
@@ -6,6 +6,11 @@ from api import *
 from options import *
 from html_exporter import *
 from json_exporter import *
+from http_pool import *
+from profile_cache import *
+from dialog_state import *
+from export_jobs import *
+from metrics import metrics
 
 
 def fetch_all_dialogs(api):
@@ -19,61 +24,54 @@ def fetch_all_dialogs(api):
         offset += len(dialogs['items'])
 
 
-api = VkApi()
-if not api.initialize():
-    sys.exit(-1)
+def main():
+    api = VkApi()
+    if not api.initialize():
+        sys.exit(-1)
 
+    options = Options()
+    http_pool.size = options.arguments.http_pool_size
+    api.rate_limiter.rate = options.arguments.api_rate
+    api.base_url = options.arguments.api_url
 
-options = Options()
+    dialogs = []
 
+    if options.arguments.person is not None:
+        dialogs = [('user', options.arguments.person)]
+    elif options.arguments.chat is not None:
+        dialogs = [('chat', options.arguments.chat)]
+    elif options.arguments.group is not None:
+        dialogs = [('group', options.arguments.group)]
+    else:
+        sys.stdout.write('You have not provided any specific dialogs to export, assuming you want to export them all...\n')
+        sys.stdout.write('Enumerating your dialogs...\n')
+        for dialog in fetch_all_dialogs(api):
+            last_msg = dialog['message']
 
-exporters = []
-
-if options.arguments.person is not None:
-    exporters = [DialogExporter(api, 'user', options.arguments.person, options)]
-elif options.arguments.chat is not None:
-    exporters = [DialogExporter(api, 'chat', options.arguments.chat, options)]
-elif options.arguments.group is not None:
-    exporters = [DialogExporter(api, 'group', options.arguments.group, options)]
-else:
-    sys.stdout.write('You have not provided any specific dialogs to export, assuming you want to export them all...\n')
-    sys.stdout.write('Enumerating your dialogs...\n')
-    for dialog in fetch_all_dialogs(api):
-        exporter = None
-
-        last_msg = dialog['message']
-
-        if 'chat_id' in last_msg:
-            # this is a group chat
-            exporter = DialogExporter(api, 'chat', last_msg['chat_id'], options)
-        else:
-            exporter = DialogExporter(api, 'user', last_msg['user_id'], options)
-
-        exporters.append(exporter)
+            if 'chat_id' in last_msg:
+                # this is a group chat
+                dialogs.append(('chat', last_msg['chat_id']))
+            else:
+                dialogs.append(('user', last_msg['user_id']))
 
-if not options.arguments.docs:
-    sys.stdout.write('Attached documents are not downloaded by default. Restart the script with --docs to enable downloading documents\n')
+    if not options.arguments.docs:
+        sys.stdout.write('Attached documents are not downloaded by default. Restart the script with --docs to enable downloading documents\n')
 
-sys.stdout.write('Exporting {0} dialog{1}\n'.format(len(exporters), 's' if len(exporters) > 1 else ''))
-progress.total_stages = len(exporters)
-for exp in exporters:
-    exported_json = exp.export()
+    sys.stdout.write('Exporting {0} dialog{1}\n'.format(len(dialogs), 's' if len(dialogs) > 1 else ''))
 
-    format_exporter = None
-    if options.output_format == 'json':
-        format_exporter = JSONExporter(options)
-    elif options.output_format == 'html':
-        format_exporter = HTMLExporter(options)
+    if options.arguments.jobs > 1 and len(dialogs) > 1:
+        export_dialogs_parallel(api, dialogs, options, min(options.arguments.jobs, len(dialogs)))
     else:
-        raise RuntimeError("Unknown format")
+        profile_cache = open_profile_cache(options)
+        blob_store = open_blob_store(options)
+        progress.total_stages = len(dialogs)
+        for dlg_type, dlg_id in dialogs:
+            export_dialog(DialogExporter(api, dlg_type, dlg_id, options, profile_cache, blob_store), options)
+            progress.next_stage()
 
-    exported_data = format_exporter.export(exported_json, progress)
-    with codecs.open(os.path.join(options.output_dir, str(exp.id) + "." + format_exporter.extension), "w", encoding="utf-8") as f:
-        f.write(exported_data['text'])
+    if options.arguments.metrics:
+        metrics.save_run(options.output_dir)
 
-    if 'files' in exported_data:
-        for filename, content in exported_data['files'].items():
-            with codecs.open(os.path.join(options.output_dir, filename), 'w', encoding='utf-8') as f:
-                f.write(content)
 
-    progress.next_stage()
+if __name__ == '__main__':
+    main()